@@ -36,22 +36,113 @@ def parse_arguments():
                      help="uploads specified file into database",
                      default=None)
 
+    par.add_argument("--ingest_dir",
+                     dest="ingest_dir",
+                     help="uploads every new data file in this folder",
+                     default=None)
+
+    par.add_argument("--patient",
+                     dest="patient",
+                     help="patient id of uploaded recordings; defaults to "
+                          "the name of the --ingest_dir folder",
+                     default=None)
+
+    par.add_argument("--recording",
+                     dest="recording",
+                     help="id of the recording to view; defaults to the "
+                          "most recently uploaded one",
+                     type=int,
+                     default=None)
+
     par.add_argument("--path",
                      dest="path",
                      help="path to folder containing input files",
                      default="data/")
 
+    par.add_argument("--database",
+                     dest="database",
+                     help="path to the SQLite database file",
+                     default="hmdata.db")
+
     par.add_argument("--convert",
                      dest="convert",
-                     help="convert lvm file to bin file with this filename",
+                     help="convert the --data file into a Holter Monitor "
+                          "recording (.hmr) with this filename",
                      default="")
 
+    par.add_argument("--data",
+                     dest="data",
+                     help="name of the data file to convert",
+                     default="ecg.lvm")
+
+    par.add_argument("--block_size",
+                     dest="block_size",
+                     help="samples per compressed block when converting; "
+                          "0 stores the samples uncompressed",
+                     type=int,
+                     default=0)
+
+    par.add_argument("--adc_scale",
+                     dest="adc_scale",
+                     help="volts per count; if given, converted samples are "
+                          "stored as int16 counts",
+                     type=float,
+                     default=None)
+
+    par.add_argument("--stream",
+                     dest="stream",
+                     help="detect PVCs chunk by chunk with bounded memory while "
+                          "the file is read; the upload still holds the "
+                          "whole recording",
+                     action="store_true")
+
+    par.add_argument("--detector",
+                     dest="detector",
+                     help="R-peak detector used for PVC detection",
+                     choices=["biosppy", "pan_tompkins"],
+                     default="biosppy")
+
+    par.add_argument("--workers",
+                     dest="workers",
+                     help="worker processes for parallel PVC detection, or "
+                          "for --ingest_dir; 0 detects PVCs in a single "
+                          "process, or ingests with one worker per CPU",
+                     type=int,
+                     default=0)
+
+    par.add_argument("--plot",
+                     dest="plot",
+                     help="show diagnostic plots of the PVC detection",
+                     action="store_true")
+
     par.add_argument("--pvc_window",
                      dest="pvc_window",
                      help="window parameter for pvc detection",
                      type=float,
                      default=10)
 
+    par.add_argument("--baseline_beats",
+                     dest="baseline_beats",
+                     help="compare each RR interval with the rolling median "
+                          "of this many intervals around it; 0 uses the "
+                          "average of its --pvc_window window",
+                     type=int,
+                     default=0)
+
+    par.add_argument("--metrics",
+                     dest="metrics",
+                     help="write the time, counts and peak memory of each "
+                          "pipeline stage to this JSON file",
+                     default=None)
+
+    par.add_argument("--profile",
+                     dest="profile",
+                     help="profile the run with cProfile and dump the "
+                          "statistics to this file",
+                     nargs="?",
+                     const="holter_monitor.prof",
+                     default=None)
+
     par.add_argument("--log",
                      default='DEBUG',
                      dest='log',
@@ -0,0 +1,359 @@
+import os
+import json
+import time as tm
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import holter_monitor_constants as hmc
+import input_reader as ir
+import database_manager as dm
+import filter_functions as ff
+import pvc_detect_two as pvc_detect
+import qrs_detect
+import instrumentation as im
+
+log = logging.getLogger("hm_logger")
+
+FORMATS = ("npy", "hmr", "txt", "lvm")
+
+LVM_HEADER = "\r\n".join([
+    "LabVIEW Measurement\t", "Writer_Version\t2", "Reader_Version\t2",
+    "Separator\tTab", "Decimal_Separator\t.", "Multi_Headings\tNo",
+    "X_Columns\tOne", "Time_Pref\tAbsolute", "***End_of_Header***\t", "\t",
+    "Channels\t1\t", "Samples\t{samples}\t", "Y_Unit_Label\tVolts\t",
+    "X_Dimension\tTime\t", "X0\t0.0000000000000000E+0\t",
+    "Delta_X\t{delta:.6f}\t", "***End_of_Header***\t\t",
+    "X_Value\tVoltage\tComment", ""])
+
+
+def beat_template(fs, pvc=False):
+    """ builds one heartbeat as a sum of gaussian waves
+
+    :param fs: sampling frequency of data
+    :param pvc: if True, a wide, inverted ectopic beat with no P wave
+    :return: (offset of the R-peak in the template, template array)
+    """
+
+    t = np.arange(-0.3, 0.5, 1.0 / fs)
+    if pvc:
+        waves = [(-1.2, 0.0, 0.035), (0.35, 0.3, 0.07)]
+    else:
+        waves = [(0.1, -0.2, 0.025), (-0.1, -0.03, 0.01), (1.0, 0.0, 0.01),
+                 (-0.2, 0.03, 0.01), (0.3, 0.25, 0.05)]
+    template = sum(a * np.exp(-((t - mu) / sigma) ** 2 / 2)
+                   for (a, mu, sigma) in waves)
+    return int(round(0.3 * fs)), template
+
+
+def synthetic_ecg(seconds, fs=hmc.SAMPLE_RATE, heart_rate=70, pvc_rate=0.05,
+                  noise=0.02, seed=0):
+    """ generates an ecg with premature ventricular contractions
+
+    every PVC comes at 65% of the RR interval and is followed by a full
+    compensatory pause; baseline wander and gaussian noise are added on top
+
+    :param seconds: length of the recording
+    :param fs: sampling frequency of data
+    :param heart_rate: mean heart rate, in beats per minute
+    :param pvc_rate: fraction of beats that are PVCs
+    :param noise: standard deviation of the noise, in volts
+    :param seed: seed of the random number generator
+    :return: ecg data array, array of the R-peak locations of the PVCs
+    """
+
+    rng = np.random.RandomState(seed)
+    length = int(seconds * fs)
+    rr = 60.0 / heart_rate
+    beats = int(seconds / rr * 1.1) + 2
+    intervals = rr * (1 + 0.03 * rng.randn(beats))
+    pvcs = rng.rand(beats) < pvc_rate
+    pvcs[:2] = False
+    pvcs[-1] = False
+    # a PVC is never the beat straight after another one
+    pvcs[1:] &= ~pvcs[:-1]
+    following = np.flatnonzero(pvcs) + 1
+    intervals[following] = 2 * intervals[following - 1] - \
+        0.65 * intervals[following - 1]
+    intervals[pvcs] *= 0.65
+    peaks = np.round(np.cumsum(intervals) * fs).astype(np.int64)
+    keep = peaks < length
+    peaks = peaks[keep]
+    pvcs = pvcs[keep]
+
+    ecg = 1.4 + 0.1 * np.sin(2 * np.pi * 0.2 * np.arange(length) / fs)
+    for is_pvc in (False, True):
+        offset, template = beat_template(fs, is_pvc)
+        for peak in peaks[pvcs == is_pvc]:
+            start = peak - offset
+            first = max(start, 0)
+            last = min(start + len(template), length)
+            ecg[first:last] += template[first - start:last - start]
+    ecg += noise * rng.randn(length)
+    return ecg.astype("float32"), peaks[pvcs]
+
+
+def write_recording(ecg, fmt, folder, fs=hmc.SAMPLE_RATE):
+    """ saves a synthetic recording in one of the supported file formats
+
+    :param ecg: ecg data array
+    :param fmt: one of FORMATS
+    :param folder: folder to write the file to
+    :param fs: sampling frequency of data
+    :return: name of the file written
+    """
+
+    filename = "synthetic." + fmt
+    path = os.path.join(folder, filename)
+    if fmt == "npy":
+        ir.save_binary(ecg, "synthetic.lvm", filename, folder)
+    elif fmt == "hmr":
+        ir.save_native([ecg], filename, folder, sample_rate=fs)
+    elif fmt == "txt":
+        counts = np.round((ecg - 1.4) / 1e-3).astype(np.int32)
+        with open(path, "w") as f:
+            for start in range(0, len(counts), hmc.READ_CHUNK_SIZE):
+                np.savetxt(f, counts[start:start + hmc.READ_CHUNK_SIZE],
+                           fmt="%d")
+    elif fmt == "lvm":
+        with open(path, "w", newline="") as f:
+            f.write(LVM_HEADER.format(samples=len(ecg), delta=1.0 / fs))
+            for start in range(0, len(ecg), hmc.READ_CHUNK_SIZE):
+                chunk = ecg[start:start + hmc.READ_CHUNK_SIZE]
+                rows = np.column_stack(
+                    (np.arange(start, start + len(chunk)) / fs, chunk))
+                np.savetxt(f, rows, fmt="%.6f", delimiter="\t",
+                           newline="\r\n")
+    else:
+        raise ValueError("unknown format " + fmt)
+    return filename
+
+
+class Timer(object):
+    """ collects the run time, throughput and peak memory of each stage
+    """
+
+    def __init__(self, hours, samples):
+        self.hours = hours
+        self.samples = samples
+        self.results = []
+
+    def run(self, stage, function, *args, **kwargs):
+        """ times one call of function
+
+        :param stage: name of the stage
+        :param function: function to call with args and kwargs
+        :param items: number of items processed, if not every sample
+        :return: what function returned
+        """
+
+        items = kwargs.pop("items", self.samples)
+        start = tm.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = tm.perf_counter() - start
+        self.results.append({
+            "hours": self.hours,
+            "stage": stage,
+            "seconds": seconds,
+            "items": items,
+            "items_per_second": items / seconds if seconds > 0 else None,
+            "peak_rss_mb": im.peak_rss(),
+        })
+        log.info("{0} h {1}: {2:.3f} s".format(self.hours, stage, seconds))
+        return result
+
+
+def detection_stages(timer, ecg, fs, window, detector):
+    """ times each stage of pvc_detect_two.detect_pvcs, then the whole of
+    process_data
+
+    :return: list of (index, certainty) PVC locations, list of R-peaks
+    """
+
+    lpf = timer.run("lowpass", ff.butter_lowpass_filter, ecg, hmc.CUTOFF, fs)
+    r_peaks, filtered = timer.run("r_peaks", qrs_detect.get_detector(detector),
+                                  lpf, fs)
+    distances, r_peak_times = timer.run("rr_intervals",
+                                        pvc_detect.get_distances, r_peaks, fs)
+    indexes, averages = timer.run("baselines", pvc_detect.get_baselines,
+                                  distances, r_peak_times, window)
+    mode = timer.run("mode", pvc_detect.get_mode, filtered)
+    timer.run("classify", pvc_detect.process_pvc, filtered, distances,
+              averages, indexes, r_peaks, hmc.PREMATURITY, hmc.COMPENSATORY,
+              hmc.DISTANCE, mode=mode)
+    beats = []
+    pvcs = timer.run("process_data", pvc_detect.process_data, fs, window, ecg,
+                     detector=detector, beats=beats)
+    return pvcs, beats
+
+
+def query_stages(timer, path, length, fs, queries, window=80):
+    """ times random viewer queries against an uploaded recording
+    """
+
+    rng = np.random.RandomState(1)
+    manager = dm.DatabaseManager(path)
+    starts = rng.uniform(0, max(length / fs - window, 0), queries)
+
+    def query_windows():
+        for start in starts:
+            manager.cache.clear()
+            manager.query_data(start, start + window)
+
+    def query_cached():
+        for start in starts:
+            manager.query_data(start, start + window)
+
+    def query_points():
+        for point in rng.randint(0, length, queries):
+            manager.query_point(point)
+
+    timer.run("query_data", query_windows, items=queries)
+    timer.run("query_data_cached", query_cached, items=queries)
+    timer.run("query_point", query_points, items=queries)
+    manager.close()
+
+
+def nearest_distances(found, targets):
+    """ distance from each target to the closest found location
+
+    :param found: sorted array of found locations
+    :param targets: array of true locations
+    :return: array of distances, inf for every target if nothing was found
+    """
+
+    targets = np.asarray(targets)
+    if len(found) == 0:
+        return np.full(len(targets), np.inf)
+    right = np.clip(np.searchsorted(found, targets), 0, len(found) - 1)
+    left = np.clip(right - 1, 0, len(found) - 1)
+    return np.minimum(np.abs(found[left] - targets),
+                      np.abs(found[right] - targets))
+
+
+def run_scale(hours, formats=FORMATS, detector="biosppy", window=10,
+              queries=hmc.BENCHMARK_QUERIES, folder=None,
+              fs=hmc.SAMPLE_RATE):
+    """ runs every benchmark on a synthetic recording of the given length
+
+    :param hours: length of the recording
+    :param formats: file formats to write and read back
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :param window: interval for average processing (seconds)
+    :param queries: number of random viewer queries of each kind
+    :param folder: scratch folder, or None for a temporary one
+    :param fs: sampling frequency of data
+    :return: list of result dictionaries, one per stage
+    """
+
+    # input_reader expects folders to end with a separator
+    scratch = os.path.join(tempfile.mkdtemp(dir=folder), "")
+    try:
+        samples = int(hours * 3600 * fs)
+        timer = Timer(hours, samples)
+        ecg, true_pvcs = timer.run("generate", synthetic_ecg, hours * 3600,
+                                   fs)
+        for fmt in formats:
+            filename = timer.run("write_" + fmt, write_recording, ecg, fmt,
+                                 scratch, fs)
+            timer.run("read_" + fmt, ir.read_data, filename, scratch)
+
+        pvcs, beats = detection_stages(timer, ecg, fs, window, detector)
+        found = np.array([p for (p, certainty) in pvcs], dtype=np.int64)
+        nearest = nearest_distances(found, true_pvcs)
+        timer.results[-1]["pvc_sensitivity"] = \
+            float(np.mean(nearest <= 0.1 * fs)) if len(true_pvcs) else None
+
+        path = os.path.join(scratch, "benchmark.db")
+        timer.run("upload", dm.upload, ir.SampleTimes(len(ecg), fs), ecg,
+                  pvcs, sample_rate=fs, path=path, r_peaks=beats)
+        query_stages(timer, path, len(ecg), fs, queries)
+        return timer.results
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(hours=hmc.BENCHMARK_HOURS, output="benchmark.json",
+                   **kwargs):
+    """ runs run_scale for each recording length in a fresh process, so
+    that peak memory is measured separately for each, and saves the results
+
+    :param hours: lengths of the recordings
+    :param output: path of the JSON file to write
+    :return: dictionary written to output
+    """
+
+    report = {
+        "commit": git_commit(),
+        "date": tm.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "results": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    for scale in hours:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            report["results"] += pool.submit(run_scale, scale,
+                                             **kwargs).result()
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def parse_arguments():
+    par = argparse.ArgumentParser(
+        description="times ingest, detection and viewer queries on "
+                    "synthetic recordings")
+    par.add_argument("--hours", nargs="+", type=float,
+                     default=list(hmc.BENCHMARK_HOURS),
+                     help="lengths of the synthetic recordings")
+    par.add_argument("--formats", nargs="+", choices=FORMATS,
+                     default=list(FORMATS),
+                     help="file formats to write and read back")
+    par.add_argument("--detector", choices=sorted(qrs_detect.detectors),
+                     default="biosppy", help="R-peak detector")
+    par.add_argument("--queries", type=int, default=hmc.BENCHMARK_QUERIES,
+                     help="random viewer queries of each kind")
+    par.add_argument("--output", default="benchmark.json",
+                     help="JSON file the results are written to")
+    par.add_argument("--folder", default=None,
+                     help="scratch folder for recordings and the database")
+    par.add_argument("--generate", default=None,
+                     help="only write a synthetic recording to this file, "
+                          "in the format given by its extension")
+    par.add_argument("--log", default="INFO", help="logging level")
+    return par.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=args.log)
+    if args.generate:
+        folder, filename = os.path.split(os.path.abspath(args.generate))
+        folder = os.path.join(folder, "")
+        ecg, _ = synthetic_ecg(args.hours[0] * 3600)
+        written = write_recording(ecg, os.path.splitext(filename)[1][1:],
+                                  folder)
+        os.replace(os.path.join(folder, written),
+                   os.path.join(folder, filename))
+    else:
+        run_benchmarks(args.hours, args.output, formats=args.formats,
+                       detector=args.detector, queries=args.queries,
+                       folder=args.folder)
@@ -1,73 +1,1095 @@
 import sqlite3 as sql3
+import threading
+import contextlib
+import queue
+import collections
+import numpy as np
+import time as tm
+import logging
+import holter_monitor_constants as hmc
+import holter_monitor_errors as hme
+import filter_functions as ff
+import instrumentation as im
+log = logging.getLogger("hm_logger")
 
+BLOB_DTYPE = np.dtype("<f4")
 
-def upload(time, ecg, pvcs):
-    conn = sql3.connect('hmdata.db')
-    c = conn.cursor()
+Metadata = collections.namedtuple(
+    "Metadata", ["recording", "length", "sample_rate", "t0", "block_size",
+                 "levels"])
 
-    c.execute("DROP TABLE IF EXISTS ecg_data")
-    c.execute("CREATE TABLE ecg_data (IND INTEGER, TIME REAL, ECG REAL)")
+# tables of the single-recording schema, which are replaced on first upload
+LEGACY_TABLES = ["ecg_data", "metadata", "ecg_blocks", "pvc_data",
+                 "envelope_levels", "ecg_envelope"]
+RECORDING_TABLES = ["ecg_blocks", "pvc_data", "envelope_levels",
+                    "ecg_envelope", "pvc_summary", "pvc_burden",
+                    "recordings"]
 
-    c.execute("DROP TABLE IF EXISTS metadata")
-    c.execute("CREATE TABLE metadata (LENGTH INTEGER)")
-    c.execute("INSERT INTO metadata (LENGTH) VALUES(?)", [len(ecg)])
+# queries run by the viewer; each must seek an index rather than scan
+METADATA_QUERY = """
+                 SELECT RECORDING, LENGTH, SAMPLE_RATE, T0, BLOCK_SIZE
+                 FROM recordings WHERE RECORDING = ?
+                 """
+LATEST_METADATA_QUERY = """
+                 SELECT RECORDING, LENGTH, SAMPLE_RATE, T0, BLOCK_SIZE
+                 FROM recordings
+                 WHERE RECORDING = (SELECT MAX(RECORDING) FROM recordings)
+                 """
+LEVELS_QUERY = """
+               SELECT LEVEL, LENGTH FROM envelope_levels
+               WHERE RECORDING = ? ORDER BY LEVEL
+               """
+PVCS_QUERY = """
+             SELECT IND, CERTAINTY, TIME, ECG FROM pvc_data
+             WHERE RECORDING = ?
+             ORDER BY IND
+             """
+SUMMARY_QUERY = """
+                SELECT BIN, BEATS, TIER1, TIER2, TIER3, TIER4, HEART_RATE
+                FROM pvc_summary
+                WHERE RECORDING = ? and BIN_SECONDS = ?
+                ORDER BY BIN
+                """
+BURDEN_QUERY = """
+               SELECT BEATS, TIER1, TIER2, TIER3, TIER4, BURDEN, HEART_RATE
+               FROM pvc_burden WHERE RECORDING = ?
+               """
+BUCKETS_QUERY = """
+                SELECT DATA FROM ecg_envelope
+                WHERE RECORDING = ? and LEVEL = ? and BLOCK >= ? and
+                      BLOCK <= ?
+                ORDER BY BLOCK
+                """
+SAMPLES_QUERY = """
+                SELECT DATA FROM ecg_blocks
+                WHERE RECORDING = ? and BLOCK >= ? and BLOCK <= ?
+                ORDER BY BLOCK
+                """
+SAMPLE_POINTS_QUERY = """
+                      SELECT BLOCK, DATA FROM ecg_blocks
+                      WHERE RECORDING = ? and BLOCK IN ({0})
+                      """
+VIEWER_QUERIES = {
+    "metadata": (METADATA_QUERY, [1]),
+    "latest_metadata": (LATEST_METADATA_QUERY, []),
+    "levels": (LEVELS_QUERY, [1]),
+    "pvcs": (PVCS_QUERY, [1]),
+    "summary": (SUMMARY_QUERY, [1, hmc.SUMMARY_BINS[0]]),
+    "burden": (BURDEN_QUERY, [1]),
+    "buckets": (BUCKETS_QUERY, [1, 1, 0, 1]),
+    "samples": (SAMPLES_QUERY, [1, 0, 1]),
+    "sample_points": (SAMPLE_POINTS_QUERY.format("?, ?"), [1, 0, 1]),
+}
 
-    c.execute("DROP TABLE IF EXISTS pvc_data")
-    c.execute("CREATE TABLE pvc_data (IND INTEGER, CERTAINTY INTEGER)")
 
-    for i, (t, e) in enumerate(zip(time, ecg)):
-        c.execute(
-            "INSERT INTO ecg_data (IND, TIME, ECG) VALUES(?, ?, ?)",
-            (i, float(t), float(e))
-        )
+def configure_bulk_load(conn):
+    """ tunes SQLite pragmas for a one-off bulk load into the database
 
-    for (ind, certainty) in pvcs:
-        c.execute(
-            "INSERT INTO pvc_data (IND, CERTAINTY) VALUES(?, ?)",
-            (int(ind), int(certainty))
-        )
+    :param conn: open database connection
+    """
 
-    conn.commit()
-    conn.close()
+    # page_size only takes effect on a fresh database file
+    conn.execute("PRAGMA page_size = 8192")
+    # WAL lets pooled readers keep their connections open during the load
+    conn.execute("PRAGMA journal_mode = WAL")
+    # NORMAL is safe with WAL: a crash can lose the load in progress, but
+    # never corrupts the recordings already in the database
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -262144")  # 256 MiB
 
 
-def query_length():
-    conn = sql3.connect('hmdata.db')
-    c = conn.cursor()
-    result = c.execute("SELECT LENGTH FROM metadata").fetchone()[0]
-    c.close()
-    return result
+def generate_blocks(ecg, block_size):
+    """ splits an ecg array into fixed-length float32 blobs
 
+    :param ecg: ecg data array
+    :param block_size: number of samples per block
+    :return: generator of (BLOCK, DATA) tuples
+    """
 
-def query_pvcs():
-    conn = sql3.connect('hmdata.db')
-    c = conn.cursor()
-    result = c.execute("SELECT IND, CERTAINTY FROM pvc_data").fetchall()
-    c.close()
-    return [[i, c] for (i, c) in result]
+    for block, start in enumerate(range(0, len(ecg), block_size)):
+        samples = np.asarray(ecg[start:start + block_size], dtype=BLOB_DTYPE)
+        yield block, samples.tobytes()
 
 
-def query_data(start, end):
-    conn = sql3.connect('hmdata.db')
-    c = conn.cursor()
-    result = c.execute("""
-              SELECT TIME, ECG FROM ecg_data
-              WHERE TIME >= ? and TIME < ?
-              ORDER BY TIME
-              """, [start, end]).fetchall()
-    time, ecg = zip(*result)
-    c.close()
-    return time, [float(s) for s in ecg]
-
-
-def query_point(point):
-    conn = sql3.connect('hmdata.db')
+def decode_blocks(blobs):
+    """ concatenates float32 blobs back into a single ecg array
+
+    :param blobs: iterable of blob byte strings, in block order
+    :return: ecg data array
+    """
+
+    arrays = [np.frombuffer(blob, dtype=BLOB_DTYPE) for blob in blobs]
+    if len(arrays) == 0:
+        return np.array([], dtype=BLOB_DTYPE)
+    return np.concatenate(arrays)
+
+
+def envelope_levels(sample_rate, level_seconds=hmc.ENVELOPE_LEVELS):
+    """ converts envelope bucket lengths from seconds into samples
+
+    :param sample_rate: sampling rate of the ecg data
+    :param level_seconds: bucket length of each pyramid level, in seconds
+    :return: sorted list of distinct bucket lengths, in samples
+    """
+
+    return sorted(set(max(1, int(round(s * sample_rate)))
+                      for s in level_seconds))
+
+
+def build_envelope(ecg, levels):
+    """ builds a decimation pyramid of per-bucket min/max envelopes
+
+    each level is reduced from the previous one whenever its bucket length
+    is a multiple of the previous bucket length, otherwise from the raw data
+
+    :param ecg: ecg data array
+    :param levels: sorted bucket lengths, in samples
+    :return: generator of (level, envelope) where envelope is an (n, 2) array
+    """
+
+    if len(ecg) == 0:
+        return
+    prev_size = 1
+    prev_min = prev_max = np.asarray(ecg, dtype=BLOB_DTYPE)
+    for level in levels:
+        if level % prev_size != 0:
+            prev_size = 1
+            prev_min = prev_max = np.asarray(ecg, dtype=BLOB_DTYPE)
+        bucket = level // prev_size
+        if prev_min is prev_max:
+            lows, highs = ff.minmax_buckets(prev_min, bucket)
+        else:
+            lows = ff.minmax_buckets(prev_min, bucket)[0]
+            highs = ff.minmax_buckets(prev_max, bucket)[1]
+        prev_min = prev_min[lows]
+        prev_max = prev_max[highs]
+        prev_size = level
+        yield level, np.column_stack((prev_min, prev_max))
+
+
+def create_schema(c):
+    """ creates the tables of the multi-recording schema if they are missing
+
+    a database written by the single-recording schema is cleared first
+
+    :param c: database cursor
+    """
+
+    columns = [row[1] for row in c.execute("PRAGMA table_info(ecg_blocks)")]
+    if len(columns) > 0 and "RECORDING" not in columns:
+        log.info("replacing the single-recording database schema")
+        for table in LEGACY_TABLES:
+            c.execute("DROP TABLE IF EXISTS " + table)
+
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS recordings (
+                  RECORDING INTEGER PRIMARY KEY AUTOINCREMENT,
+                  NAME TEXT, PATIENT TEXT,
+                  HASH TEXT UNIQUE, LENGTH INTEGER, SAMPLE_RATE REAL,
+                  T0 REAL, BLOCK_SIZE INTEGER, UPLOADED REAL)
+              """)
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS ecg_blocks (
+                  RECORDING INTEGER, BLOCK INTEGER, DATA BLOB,
+                  PRIMARY KEY (RECORDING, BLOCK))
+              """)
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS pvc_data (
+                  RECORDING INTEGER, IND INTEGER, CERTAINTY INTEGER,
+                  TIME REAL, ECG REAL)
+              """)
+    c.execute("""
+              CREATE INDEX IF NOT EXISTS pvc_data_recording
+              ON pvc_data (RECORDING, IND)
+              """)
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS envelope_levels (
+                  RECORDING INTEGER, LEVEL INTEGER, LENGTH INTEGER,
+                  PRIMARY KEY (RECORDING, LEVEL))
+              """)
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS ecg_envelope (
+                  RECORDING INTEGER, LEVEL INTEGER, BLOCK INTEGER, DATA BLOB,
+                  PRIMARY KEY (RECORDING, LEVEL, BLOCK))
+              """)
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS pvc_summary (
+                  RECORDING INTEGER, BIN_SECONDS INTEGER, BIN INTEGER,
+                  BEATS INTEGER, TIER1 INTEGER, TIER2 INTEGER, TIER3 INTEGER,
+                  TIER4 INTEGER, HEART_RATE REAL,
+                  PRIMARY KEY (RECORDING, BIN_SECONDS, BIN))
+              """)
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS pvc_burden (
+                  RECORDING INTEGER PRIMARY KEY, BEATS INTEGER,
+                  TIER1 INTEGER, TIER2 INTEGER, TIER3 INTEGER, TIER4 INTEGER,
+                  BURDEN REAL, HEART_RATE REAL)
+              """)
+
+
+def delete_recording(c, recording):
+    """ removes a recording and everything derived from it
+
+    :param c: database cursor
+    :param recording: id of the recording
+    """
+
+    for table in RECORDING_TABLES:
+        c.execute("DELETE FROM " + table + " WHERE RECORDING = ?",
+                  [recording])
+
+
+def query_hashes(path=hmc.DATABASE_PATH):
+    """ reads the content hashes of every uploaded recording
+
+    :param path: path of the database file
+    :return: set of hash strings
+    """
+
+    conn = sql3.connect(path)
+    try:
+        c = conn.cursor()
+        create_schema(c)
+        conn.commit()
+        return set(h for (h,) in c.execute(
+            "SELECT HASH FROM recordings WHERE HASH IS NOT NULL"))
+    finally:
+        conn.close()
+
+
+def summarize(pvcs, r_peaks, length, sample_rate, bin_seconds):
+    """ counts beats and PVCs of each certainty in fixed-length bins
+
+    :param pvcs: list of (index, certainty) tuples from PVC detection
+    :param r_peaks: array of R-peak indices, or None if unknown
+    :param length: number of samples in the recording
+    :param sample_rate: sampling rate of the ecg data
+    :param bin_seconds: length of each bin, in seconds, or None for a
+                        single bin holding the whole recording
+    :return: beats per bin (None without r_peaks), (n, 4) PVC counts per
+             bin and tier, and heart rate per bin in beats per minute
+             (NaN where no RR interval ends in the bin)
+    """
+
+    bin_size = length if bin_seconds is None else \
+        int(round(bin_seconds * sample_rate))
+    bins = max(-(-length // max(bin_size, 1)), 1)
+    pvcs = np.asarray(pvcs, dtype=np.int64).reshape(-1, 2)
+    tiers = np.bincount(4 * (pvcs[:, 0] // max(bin_size, 1)) + pvcs[:, 1] - 1,
+                        minlength=4 * bins)[:4 * bins].reshape(bins, 4)
+    if r_peaks is None:
+        return None, tiers, np.full(bins, np.nan)
+
+    r_peaks = np.asarray(r_peaks, dtype=np.int64)
+    beats = np.bincount(r_peaks // max(bin_size, 1), minlength=bins)[:bins]
+    # each RR interval counts towards the bin of the beat that ends it
+    ends = r_peaks[1:] // max(bin_size, 1)
+    rr_sums = np.bincount(ends, weights=np.diff(r_peaks), minlength=bins)
+    rr_counts = np.bincount(ends, minlength=bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        heart_rate = 60.0 * sample_rate * rr_counts[:bins] / rr_sums[:bins]
+    return beats, tiers, heart_rate
+
+
+def upload_summary(c, recording, pvcs, r_peaks, length, sample_rate):
+    """ stores per-bin PVC counts and heart rate, and the PVC burden, so
+    statistics never need a scan of pvc_data
+
+    :param c: database cursor
+    :param recording: id of the recording
+    :param pvcs: list of (index, certainty) tuples from PVC detection
+    :param r_peaks: array of R-peak indices, or None if unknown
+    :param length: number of samples in the recording
+    :param sample_rate: sampling rate of the ecg data
+    """
+
+    def nullable(value):
+        return None if value is None or np.isnan(value) else float(value)
+
+    for bin_seconds in hmc.SUMMARY_BINS:
+        beats, tiers, heart_rate = summarize(pvcs, r_peaks, length,
+                                             sample_rate, bin_seconds)
+        c.executemany("""
+                      INSERT INTO pvc_summary (RECORDING, BIN_SECONDS, BIN,
+                          BEATS, TIER1, TIER2, TIER3, TIER4, HEART_RATE)
+                      VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+                      """,
+                      [(recording, bin_seconds, i,
+                        None if beats is None else int(beats[i]),
+                        int(counts[0]), int(counts[1]), int(counts[2]),
+                        int(counts[3]), nullable(heart_rate[i]))
+                       for i, counts in enumerate(tiers)])
+
+    beats, tiers, heart_rate = summarize(pvcs, r_peaks, length, sample_rate,
+                                         None)
+    total = None if beats is None else int(beats[0])
+    burden = 100.0 * tiers[0, 3] / total if total else None
+    c.execute("""
+              INSERT INTO pvc_burden (RECORDING, BEATS, TIER1, TIER2, TIER3,
+                                      TIER4, BURDEN, HEART_RATE)
+              VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+              """, [recording, total] + [int(n) for n in tiers[0]] +
+              [burden, nullable(heart_rate[0])])
+
+
+def upload_envelope(c, recording, ecg, sample_rate):
+    """ stores the min/max pyramid of a recording in blocks of buckets
+
+    :param c: database cursor
+    :param recording: id of the recording
+    :param ecg: ecg data array
+    :param sample_rate: sampling rate of the ecg data
+    :return: number of rows written
+    """
+
+    rows = 0
+    for level, envelope in build_envelope(
+            ecg, envelope_levels(sample_rate)):
+        c.execute("""
+                  INSERT INTO envelope_levels (RECORDING, LEVEL, LENGTH)
+                  VALUES(?, ?, ?)
+                  """, [recording, level, len(envelope)])
+        c.executemany("""
+                      INSERT INTO ecg_envelope (RECORDING, LEVEL, BLOCK, DATA)
+                      VALUES(?, ?, ?, ?)
+                      """,
+                      ((recording, level, block, data)
+                       for (block, data) in generate_blocks(
+                          envelope, hmc.ENVELOPE_BLOCK_SIZE)))
+        rows += 1 + c.rowcount
+    return rows
+
+
+def upload(time, ecg, pvcs,
+           sample_rate=hmc.SAMPLE_RATE,
+           block_seconds=hmc.BLOCK_SECONDS,
+           path=hmc.DATABASE_PATH,
+           name=None,
+           patient=None,
+           content_hash=None,
+           r_peaks=None):
+    """ bulk loads a recording and its detected PVCs into the database
+
+    samples are stored as fixed-length float32 blocks keyed by recording and
+    block index; time is not stored since it is always
+    t0 + index / sample_rate. A recording with the same content hash is
+    replaced.
+
+    :param time: time data array
+    :param ecg: ecg data array
+    :param pvcs: list of (index, certainty) tuples from PVC detection
+    :param sample_rate: sampling rate of the ecg data
+    :param block_seconds: length of each stored block, in seconds
+    :param path: path of the database file
+    :param name: name of the recording, usually its file name
+    :param patient: id of the patient the recording belongs to
+    :param content_hash: hash of the file the recording was read from
+    :param r_peaks: R-peak indices found by PVC detection, for the beat
+                    counts, heart rate and PVC burden
+    :return: id of the new recording
+    """
+
+    block_size = int(block_seconds * sample_rate)
+    t0 = float(time[0]) if len(time) > 0 else 0.0
+
+    conn = sql3.connect(path, isolation_level=None)
+    configure_bulk_load(conn)
     c = conn.cursor()
-    time, ecg = c.execute("""
-              SELECT TIME, ECG FROM ecg_data
-              WHERE IND = ?
-              ORDER BY TIME
-              """, [int(point)]).fetchone()
-    c.close()
-    result = (time, float(ecg))
-    return result
+    start_time = tm.perf_counter()
+
+    c.execute("BEGIN")
+    try:
+        create_schema(c)
+
+        if content_hash is not None:
+            for (old,) in c.execute(
+                    "SELECT RECORDING FROM recordings WHERE HASH = ?",
+                    [content_hash]).fetchall():
+                log.info("replacing recording {0}".format(old))
+                delete_recording(c, old)
+
+        c.execute("""
+                  INSERT INTO recordings (NAME, PATIENT, HASH, LENGTH,
+                                          SAMPLE_RATE, T0, BLOCK_SIZE,
+                                          UPLOADED)
+                  VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+                  """, [name, patient, content_hash, len(ecg),
+                        float(sample_rate), t0, block_size, tm.time()])
+        recording = c.lastrowid
+
+        with im.stage("upload_blocks", samples=len(ecg)) as record:
+            c.executemany(
+                "INSERT INTO ecg_blocks (RECORDING, BLOCK, DATA) "
+                "VALUES(?, ?, ?)",
+                ((recording, block, data)
+                 for (block, data) in generate_blocks(ecg, block_size))
+            )
+            record["rows_written"] = c.rowcount
+
+        with im.stage("upload_envelope", samples=len(ecg)) as record:
+            record["rows_written"] = upload_envelope(c, recording, ecg,
+                                                     sample_rate)
+        with im.stage("upload_summary", pvcs=len(pvcs)):
+            upload_summary(c, recording, pvcs, r_peaks, len(ecg),
+                           sample_rate)
+
+        # the time and amplitude of each PVC are stored alongside it so the
+        # viewer never has to look them up in ecg_blocks
+        with im.stage("upload_pvcs") as record:
+            c.executemany("""
+                          INSERT INTO pvc_data (RECORDING, IND, CERTAINTY,
+                                                TIME, ECG)
+                          VALUES(?, ?, ?, ?, ?)
+                          """,
+                          [(recording, int(ind), int(certainty),
+                            t0 + int(ind) / sample_rate, float(ecg[int(ind)]))
+                           for (ind, certainty) in pvcs])
+            record["rows_written"] = c.rowcount
+
+        with im.stage("commit"):
+            c.execute("COMMIT")
+    except BaseException:
+        # a half-written recording is never left in the database
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        log.error("upload of {0} failed; rolled back".format(name))
+        raise
+    finally:
+        conn.close()
+
+    elapsed = tm.perf_counter() - start_time
+    log.info("uploaded {0} samples as recording {1} in {2:.2f}s "
+             "({3:.0f} samples/s)".format(len(ecg), recording, elapsed,
+                                          len(ecg) / max(elapsed, 1e-9)))
+    return recording
+
+
+class WindowCache(object):
+    """ least-recently-used cache of decoded, fixed-length windows of
+    samples, shared by every session querying the same database
+
+    windows can also be requested ahead of time; a background thread then
+    loads them so that panning onto them does not wait on SQLite. A window
+    is only ever loaded by one thread at a time; any other thread asking
+    for it waits for that load. Recording ids are never reused, so cached
+    windows stay valid.
+
+    """
+
+    def __init__(self, manager, max_bytes=hmc.CACHE_BYTES,
+                 tile_seconds=hmc.CACHE_TILE_SECONDS):
+        self.manager = manager
+        self.max_bytes = max_bytes
+        self.tile_seconds = tile_seconds
+        self.tiles = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._loading = {}
+        self._thread = None
+
+    def tile_size(self, metadata):
+        """ samples per window, rounded to whole storage blocks
+        """
+
+        blocks = max(1, int(round(self.tile_seconds * metadata.sample_rate /
+                                  metadata.block_size)))
+        return blocks * metadata.block_size
+
+    def read(self, metadata, first, last):
+        """ returns samples [first, last) of a recording, decoding only the
+        windows that are not cached
+
+        :param metadata: Metadata of the recording
+        :param first: index of the first sample
+        :param last: index one past the last sample
+        :return: ecg data array
+        """
+
+        first = max(first, 0)
+        last = min(last, metadata.length)
+        if last <= first:
+            return np.array([], dtype=BLOB_DTYPE)
+        size = self.tile_size(metadata)
+        tiles = range(first // size, (last - 1) // size + 1)
+        ecg = np.concatenate([self.get(metadata, tile) for tile in tiles])
+        offset = tiles[0] * size
+        return ecg[first - offset:last - offset]
+
+    def get(self, metadata, tile):
+        key = (metadata.recording, tile)
+        with self._lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return self.tiles[key]
+            self.misses += 1
+        return self.load(metadata, tile)
+
+    def load(self, metadata, tile, prefetching=False):
+        """ decodes a window into the cache, or waits for the thread that is
+        already decoding it
+
+        :param metadata: Metadata of the recording
+        :param tile: index of the window
+        :param prefetching: True if called by the prefetch thread
+        :return: ecg data array of the window
+        """
+
+        key = (metadata.recording, tile)
+        with self._lock:
+            if key in self.tiles:
+                return self.tiles[key]
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = threading.Event()
+                waiting = False
+            else:
+                waiting = True
+        if waiting:
+            loading.wait()
+            with self._lock:
+                if key in self.tiles:
+                    return self.tiles[key]
+            # the load failed, or the window was evicted again already
+            return self.load(metadata, tile, prefetching)
+
+        try:
+            size = self.tile_size(metadata)
+            with self.manager.connection() as entry:
+                c = entry["conn"].cursor()
+                samples = query_samples(c, metadata, tile * size,
+                                        (tile + 1) * size)
+                c.close()
+            # windows are shared between sessions, so none may change them
+            samples.flags.writeable = False
+            with self._lock:
+                self.tiles[key] = samples
+                self.bytes += samples.nbytes
+                if prefetching:
+                    self.prefetched += 1
+                while self.bytes > self.max_bytes and len(self.tiles) > 1:
+                    _, evicted = self.tiles.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+                    self.evictions += 1
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        return samples
+
+    def prefetch(self, metadata, first, last):
+        """ queues the windows covering samples [first, last) to be loaded
+        in the background
+
+        :param metadata: Metadata of the recording
+        :param first: index of the first sample
+        :param last: index one past the last sample
+        """
+
+        first = max(first, 0)
+        last = min(last, metadata.length)
+        if last <= first:
+            return
+        size = self.tile_size(metadata)
+        with self._lock:
+            for tile in range(first // size, (last - 1) // size + 1):
+                key = (metadata.recording, tile)
+                if key not in self.tiles and key not in self._pending and \
+                        key not in self._loading:
+                    self._pending.add(key)
+                    self._queue.put((metadata, tile))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._prefetch_loop,
+                                                name="window-prefetch")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _prefetch_loop(self):
+        while True:
+            metadata, tile = self._queue.get()
+            key = (metadata.recording, tile)
+            try:
+                with self._lock:
+                    # a session may have loaded the window in the meantime,
+                    # or be loading it now
+                    skip = key in self.tiles or key in self._loading
+                if not skip:
+                    self.load(metadata, tile, prefetching=True)
+            except Exception as e:
+                log.error("could not prefetch window {0}: {1}".format(key, e))
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+    def stats(self):
+        """ reports how well the cache is doing
+
+        :return: dictionary of hit and miss counts, hit rate, windows loaded
+                 by the prefetcher, evictions and memory use
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / float(lookups) if lookups else 0.0,
+                    "prefetched": self.prefetched,
+                    "evictions": self.evictions,
+                    "windows": len(self.tiles),
+                    "bytes": self.bytes}
+
+    def clear(self):
+        with self._lock:
+            self.tiles.clear()
+            self.bytes = 0
+
+
+class DatabaseManager(object):
+    """ owns a small thread-safe pool of long-lived read connections to a
+    Holter Monitor database, so that concurrent Bokeh sessions can query it
+    without reconnecting or re-preparing statements on every call
+
+    """
+
+    def __init__(self, path=hmc.DATABASE_PATH, pool_size=hmc.POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self.cache = WindowCache(self)
+
+    def _connect(self):
+        conn = sql3.connect(self.path,
+                            check_same_thread=False,
+                            cached_statements=hmc.CACHED_STATEMENTS)
+        conn.execute("PRAGMA query_only = ON")
+        return {"conn": conn, "version": None, "metadata": {}}
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ borrows a connection from the pool for the duration of a query
+
+        :return: context manager yielding the pool entry, a dictionary
+                 holding the connection and its cached metadata
+        """
+
+        with self._lock:
+            create = self._pool.empty() and self._created < self.pool_size
+            if create:
+                self._created += 1
+        entry = self._connect() if create else self._pool.get()
+        try:
+            yield entry
+        finally:
+            self._pool.put(entry)
+
+    @contextlib.contextmanager
+    def cursor(self, recording=None):
+        """ borrows a cursor and the metadata of the recording it queries
+
+        :param recording: id of the recording to query, or None for the most
+                          recently uploaded one
+        :return: context manager yielding (cursor, metadata)
+        """
+
+        with self.connection() as entry:
+            c = entry["conn"].cursor()
+            # data_version changes whenever another connection commits, so
+            # the cached metadata is refreshed after a new upload
+            version = c.execute("PRAGMA data_version").fetchone()[0]
+            if version != entry["version"]:
+                entry["metadata"] = {}
+                entry["version"] = version
+            if recording not in entry["metadata"]:
+                entry["metadata"][recording] = query_metadata(c, recording)
+            yield c, entry["metadata"][recording]
+            c.close()
+
+    def close(self):
+        """ closes every idle connection in the pool
+        """
+
+        while not self._pool.empty():
+            self._pool.get()["conn"].close()
+            with self._lock:
+                self._created -= 1
+
+    def upload(self, time, ecg, pvcs, **kwargs):
+        recording = upload(time, ecg, pvcs, path=self.path, **kwargs)
+        self.cache.clear()
+        return recording
+
+    def query_recordings(self):
+        """ lists the uploaded recordings, oldest first
+
+        :return: list of [recording, name, patient, length, sample_rate, t0]
+        """
+
+        with self.connection() as entry:
+            try:
+                result = entry["conn"].execute("""
+                          SELECT RECORDING, NAME, PATIENT, LENGTH,
+                                 SAMPLE_RATE, T0
+                          FROM recordings ORDER BY RECORDING
+                          """).fetchall()
+            except sql3.OperationalError:
+                result = []
+        return [list(row) for row in result]
+
+    def query_length(self, recording=None):
+        with self.cursor(recording) as (c, metadata):
+            return metadata.length
+
+    def query_pvcs(self, recording=None):
+        with self.cursor(recording) as (c, metadata):
+            result = c.execute(PVCS_QUERY, [metadata.recording]).fetchall()
+        return [[i, c, t, e] for (i, c, t, e) in result]
+
+    def query_summary(self, bin_seconds=hmc.SUMMARY_BINS[0],
+                      recording=None):
+        """ reads the stored per-bin PVC counts of a recording
+
+        :param bin_seconds: length of each bin, one of hmc.SUMMARY_BINS
+        :param recording: id of the recording, or None for the latest
+        :return: list of [start time, beats, tier 1, tier 2, tier 3,
+                 tier 4 PVC counts, heart rate] per bin
+        """
+
+        with self.cursor(recording) as (c, metadata):
+            result = c.execute(SUMMARY_QUERY,
+                               [metadata.recording, bin_seconds]).fetchall()
+        return [[metadata.t0 + b * bin_seconds] + list(row)
+                for (b, *row) in result]
+
+    def query_burden(self, recording=None):
+        """ reads the PVC totals of a recording
+
+        :param recording: id of the recording, or None for the latest
+        :return: [beats, tier 1, tier 2, tier 3, tier 4 PVC counts,
+                 PVC burden in percent of beats, mean heart rate], or None
+                 if no totals were stored for the recording
+        """
+
+        with self.cursor(recording) as (c, metadata):
+            result = c.execute(BURDEN_QUERY, [metadata.recording]).fetchone()
+        if result is None:
+            return None
+        return list(result)
+
+    def metadata(self, recording=None):
+        with self.cursor(recording) as (c, metadata):
+            return metadata
+
+    def query_data(self, start, end, recording=None):
+        metadata = self.metadata(recording)
+        first, last = sample_range(metadata, start, end)
+        ecg = self.cache.read(metadata, first, last)
+        first = max(first, 0)
+        time = metadata.t0 + \
+            np.arange(first, first + len(ecg)) / metadata.sample_rate
+        return time, ecg
+
+    def prefetch(self, start, end, recording=None):
+        """ loads the samples in [start, end) into the window cache in the
+        background
+
+        :param start: start time, in seconds
+        :param end: end time, in seconds
+        :param recording: id of the recording, or None for the latest
+        """
+
+        metadata = self.metadata(recording)
+        self.cache.prefetch(metadata, *sample_range(metadata, start, end))
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def check_query_plans(self):
+        with self.connection() as entry:
+            c = entry["conn"].cursor()
+            try:
+                return unindexed_queries(c)
+            finally:
+                c.close()
+
+    def query_point(self, point, recording=None):
+        with self.cursor(recording) as (c, metadata):
+            ecg = query_samples(c, metadata, int(point), int(point) + 1)
+        return metadata.t0 + int(point) / metadata.sample_rate, float(ecg[0])
+
+    def query_points(self, points, recording=None):
+        with self.cursor(recording) as (c, metadata):
+            points = np.asarray(points, dtype=np.int64)
+            ecg = query_sample_points(c, metadata, points)
+        return metadata.t0 + points / metadata.sample_rate, ecg
+
+    def envelope_level(self, duration, max_points=hmc.MAX_PLOT_POINTS,
+                       recording=None):
+        """ picks the finest resolution that shows a time span in at most
+        max_points points
+
+        :param duration: length of the time span, in seconds
+        :param max_points: maximum number of points to return
+        :param recording: id of the recording, or None for the latest
+        :return: bucket length in samples, or 0 for raw samples
+        """
+
+        with self.cursor(recording) as (c, metadata):
+            return select_level(metadata, duration, max_points)
+
+    def query_envelope(self, start, end, max_points=hmc.MAX_PLOT_POINTS,
+                       recording=None):
+        """ queries the data in [start, end) at the finest resolution that
+        fits in max_points; pyramid levels are returned as alternating
+        min/max points at the center of each bucket
+
+        :param start: start time, in seconds
+        :param end: end time, in seconds
+        :param max_points: maximum number of points to return
+        :param recording: id of the recording, or None for the latest
+        :return: time data array, ecg data array, level used (0 for raw)
+        """
+
+        metadata = self.metadata(recording)
+        level = select_level(metadata, end - start, max_points)
+        if level == 0:
+            time, ecg = self.query_data(start, end, metadata.recording)
+            return time, ecg, level
+
+        with self.cursor(metadata.recording) as (c, metadata):
+            first, last = sample_range(metadata, start, end)
+            first_bucket = max(first // level, 0)
+            last_bucket = -(-last // level)
+            envelope = query_buckets(c, metadata, level,
+                                     first_bucket, last_bucket)
+        buckets = np.arange(first_bucket, first_bucket + len(envelope))
+        centers = metadata.t0 + (buckets + 0.5) * level / metadata.sample_rate
+        return np.repeat(centers, 2), envelope.ravel(), level
+
+
+def query_metadata(c, recording=None):
+    """ reads the storage parameters of an uploaded recording
+
+    :param c: database cursor
+    :param recording: id of the recording, or None for the most recently
+                      uploaded one
+    :return: Metadata
+    """
+
+    try:
+        if recording is None:
+            row = c.execute(LATEST_METADATA_QUERY).fetchone()
+        else:
+            row = c.execute(METADATA_QUERY, [recording]).fetchone()
+    except sql3.OperationalError:
+        row = None
+    if row is None:
+        message = "no recordings in the database" if recording is None \
+            else "recording {0} is not in the database".format(recording)
+        log.error(message)
+        raise hme.MissingDataError(message)
+
+    levels = dict(c.execute(LEVELS_QUERY, [row[0]]).fetchall())
+    return Metadata(*(tuple(row) + (levels,)))
+
+
+def sample_range(metadata, start, end):
+    """ converts a time range into the sample range [first, last) it covers
+
+    :param metadata: Metadata of the recording
+    :param start: start time, in seconds
+    :param end: end time, in seconds
+    :return: first and last sample indices (may lie outside the recording)
+    """
+
+    first = int(np.ceil((start - metadata.t0) * metadata.sample_rate))
+    last = int(np.ceil((end - metadata.t0) * metadata.sample_rate))
+    return first, last
+
+
+def select_level(metadata, duration, max_points):
+    """ picks the finest pyramid level showing duration seconds of data in
+    at most max_points points
+
+    :param metadata: Metadata of the recording
+    :param duration: length of the time span, in seconds
+    :param max_points: maximum number of points to return
+    :return: bucket length in samples, or 0 for raw samples
+    """
+
+    samples = duration * metadata.sample_rate
+    if samples <= max_points or len(metadata.levels) == 0:
+        return 0
+    for level in sorted(metadata.levels):
+        if 2 * samples / level <= max_points:
+            return level
+    return max(metadata.levels)
+
+
+def query_buckets(c, metadata, level, first, last):
+    """ decodes the min/max envelope of buckets [first, last) of a level
+
+    :param c: database cursor
+    :param metadata: Metadata of the recording
+    :param level: bucket length of the pyramid level, in samples
+    :param first: index of the first bucket
+    :param last: index one past the last bucket
+    :return: (n, 2) array of bucket minima and maxima
+    """
+
+    first = max(first, 0)
+    last = min(last, metadata.levels[level])
+    if last <= first:
+        return np.empty((0, 2), dtype=BLOB_DTYPE)
+
+    block_size = hmc.ENVELOPE_BLOCK_SIZE
+    first_block = first // block_size
+    last_block = (last - 1) // block_size
+    result = c.execute(BUCKETS_QUERY, [metadata.recording, level,
+                                       first_block, last_block]).fetchall()
+    offset = first_block * block_size
+    envelope = decode_blocks([blob for (blob,) in result]).reshape(-1, 2)
+    return envelope[first - offset:last - offset]
+
+
+def query_samples(c, metadata, first, last):
+    """ decodes the samples in [first, last) from the blocks that cover them
+
+    :param c: database cursor
+    :param metadata: Metadata of the recording
+    :param first: index of the first sample
+    :param last: index one past the last sample
+    :return: ecg data array
+    """
+
+    block_size = metadata.block_size
+    first = max(first, 0)
+    last = min(last, metadata.length)
+    if last <= first:
+        return np.array([], dtype=BLOB_DTYPE)
+
+    first_block = first // block_size
+    last_block = (last - 1) // block_size
+    result = c.execute(SAMPLES_QUERY, [metadata.recording, first_block,
+                                       last_block]).fetchall()
+    offset = first_block * block_size
+    return decode_blocks([blob for (blob,) in result])[
+        first - offset:last - offset]
+
+
+def query_sample_points(c, metadata, points):
+    """ decodes individual samples, reading each covering block only once
+
+    :param c: database cursor
+    :param metadata: Metadata of the recording
+    :param points: array of sample indices
+    :return: ecg data array with one value per index
+    """
+
+    block_size = metadata.block_size
+    if np.any((points < 0) | (points >= metadata.length)):
+        raise IndexError("sample index out of range")
+
+    blocks = np.unique(points // block_size)
+    decoded = {}
+    # stay under SQLite's limit on the number of bound parameters
+    for start in range(0, len(blocks), hmc.QUERY_BATCH_SIZE):
+        batch = [int(b) for b in blocks[start:start + hmc.QUERY_BATCH_SIZE]]
+        result = c.execute(
+            SAMPLE_POINTS_QUERY.format(", ".join("?" * len(batch))),
+            [metadata.recording] + batch).fetchall()
+        for (block, blob) in result:
+            decoded[block] = np.frombuffer(blob, dtype=BLOB_DTYPE)
+
+    ecg = np.empty(len(points), dtype=BLOB_DTYPE)
+    for i, point in enumerate(points):
+        ecg[i] = decoded[int(point) // block_size][int(point) % block_size]
+    return ecg
+
+
+def unindexed_queries(c):
+    """ checks that SQLite answers every viewer query with an index seek,
+    so that their cost does not grow with the length of a recording
+
+    :param c: database cursor on a database with the current schema
+    :return: dictionary of query name to query plan, for every viewer
+             query that scans a table or sorts its result
+    """
+
+    failures = {}
+    for name, (query, params) in sorted(VIEWER_QUERIES.items()):
+        plan = [row[-1] for row in
+                c.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+        if any(step.startswith("SCAN") or "TEMP B-TREE" in step
+               for step in plan):
+            log.error("query {0} does not use an index: {1}".format(
+                name, "; ".join(plan)))
+            failures[name] = plan
+    return failures
+
+
+managers = {}
+managers_lock = threading.Lock()
+
+
+def get_manager(path=hmc.DATABASE_PATH):
+    """ returns the process-wide DatabaseManager for a database file, so
+    that every Bokeh session of the same database shares one pool
+
+    :param path: path of the database file
+    :return: DatabaseManager
+    """
+
+    with managers_lock:
+        if path not in managers:
+            managers[path] = DatabaseManager(path)
+        return managers[path]
+
+
+def query_recordings():
+    return get_manager().query_recordings()
+
+
+def query_length(recording=None):
+    return get_manager().query_length(recording)
+
+
+def query_pvcs(recording=None):
+    return get_manager().query_pvcs(recording)
+
+
+def query_summary(bin_seconds=hmc.SUMMARY_BINS[0], recording=None):
+    return get_manager().query_summary(bin_seconds, recording)
+
+
+def query_burden(recording=None):
+    return get_manager().query_burden(recording)
+
+
+def query_data(start, end, recording=None):
+    return get_manager().query_data(start, end, recording)
+
+
+def query_point(point, recording=None):
+    return get_manager().query_point(point, recording)
+
+
+def query_points(points, recording=None):
+    return get_manager().query_points(points, recording)
+
+
+def query_envelope(start, end, max_points=hmc.MAX_PLOT_POINTS,
+                   recording=None):
+    return get_manager().query_envelope(start, end, max_points, recording)
+
+
+def check_query_plans():
+    return get_manager().check_query_plans()
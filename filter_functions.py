@@ -1,6 +1,154 @@
 import numpy as np
-from scipy.signal import butter, lfilter, freqz
-import matplotlib.pyplot as plt
+from scipy.signal import butter, iirnotch, tf2sos, sosfilt, sosfilt_zi, \
+    sosfiltfilt
+from functools import lru_cache
+import holter_monitor_constants as hmc
+
+
+@lru_cache(maxsize=None)
+def design_sos(btype, cutoff, fs, order=5):
+    """ designs a Butterworth or notch filter as second-order sections
+
+    designs are cached, so filters rebuilt for every chunk or segment share
+    their coefficients; the returned array must not be modified
+
+    :param btype: 'low', 'high', 'bandpass' or 'notch'
+    :param cutoff: cutoff frequency, (low, high) band, or notch frequency
+    :param fs: sampling frequency of data
+    :param order: order of a Butterworth filter, or the quality factor of
+                  a notch
+    :return: array of second-order sections
+    """
+
+    if btype == "notch":
+        return tf2sos(*iirnotch(cutoff, order, fs=fs))
+    return butter(order, cutoff, btype=btype, fs=fs, output="sos")
+
+
+class Filter(object):
+    """ filter that carries its state from one chunk to the next
+
+    process() filters causally and continues where the last chunk ended,
+    starting from rest; filtfilt() runs the same filter forwards and
+    backwards over a whole recording for zero phase
+
+    """
+
+    def __init__(self, btype, cutoff, fs, order=5):
+        if not np.isscalar(cutoff):
+            cutoff = tuple(cutoff)
+        self.sos = design_sos(btype, cutoff, fs, order)
+        self.zi = None
+
+    def process(self, chunk):
+        if self.zi is None:
+            self.zi = np.zeros((len(self.sos), 2))
+        y, self.zi = sosfilt(self.sos, chunk, zi=self.zi)
+        return y
+
+    def reset(self):
+        self.zi = None
+
+    def settle(self, value):
+        """ sets the state to a steady input of value, so a recording that
+        starts away from zero does not ring
+
+        :param value: first sample of the data to be processed
+        """
+
+        self.zi = sosfilt_zi(self.sos) * value
+
+    def filtfilt(self, data):
+        return sosfiltfilt(self.sos, data)
+
+
+class Pipeline(object):
+    """ chain of filters applied in order
+    """
+
+    def __init__(self, *filters):
+        self.filters = list(filters)
+
+    def process(self, chunk):
+        for stage in self.filters:
+            chunk = stage.process(chunk)
+        return chunk
+
+    def reset(self):
+        for stage in self.filters:
+            stage.reset()
+
+    def filtfilt(self, data):
+        for stage in self.filters:
+            data = stage.filtfilt(data)
+        return data
+
+
+def lowpass(cutoff=hmc.CUTOFF, fs=hmc.SAMPLE_RATE, order=5):
+    return Filter("low", cutoff, fs, order)
+
+
+def highpass(cutoff=hmc.BASELINE_CUTOFF, fs=hmc.SAMPLE_RATE, order=2):
+    """ removes baseline wander
+    """
+
+    return Filter("high", cutoff, fs, order)
+
+
+def bandpass(band, fs=hmc.SAMPLE_RATE, order=2):
+    return Filter("bandpass", band, fs, order)
+
+
+def notch(frequency=hmc.MAINS_FREQUENCY, fs=hmc.SAMPLE_RATE,
+          quality=hmc.NOTCH_QUALITY):
+    """ removes mains interference
+    """
+
+    return Filter("notch", frequency, fs, quality)
+
+
+def ecg_pipeline(fs=hmc.SAMPLE_RATE, cutoff=hmc.CUTOFF, baseline=True,
+                 mains=False):
+    """ builds the usual preprocessing chain for an ecg
+
+    :param fs: sampling frequency of data
+    :param cutoff: low-pass cutoff frequency
+    :param baseline: if True, starts with a baseline wander high-pass
+    :param mains: if True, ends with a mains notch
+    :return: Pipeline
+    """
+
+    stages = []
+    if baseline:
+        stages.append(highpass(fs=fs))
+    stages.append(lowpass(cutoff, fs))
+    if mains and hmc.MAINS_FREQUENCY < fs / 2:
+        stages.append(notch(fs=fs))
+    return Pipeline(*stages)
+
+
+def minmax_buckets(signal, bucket):
+    """ finds the smallest and largest sample of each bucket of a signal,
+    which is how every plot and stored envelope is reduced
+
+    :param signal: data array
+    :param bucket: samples per bucket; the last bucket may be shorter
+    :return: (lows, highs) arrays of the index of each bucket's minimum and
+             maximum
+    """
+
+    signal = np.asarray(signal)
+    starts = np.arange(0, len(signal), bucket)
+    lows = np.empty(len(starts), dtype=np.intp)
+    highs = np.empty(len(starts), dtype=np.intp)
+    full = len(signal) // bucket
+    buckets = signal[:full * bucket].reshape(full, bucket)
+    lows[:full] = np.argmin(buckets, axis=1)
+    highs[:full] = np.argmax(buckets, axis=1)
+    if full < len(starts):
+        lows[full] = np.argmin(signal[starts[full]:])
+        highs[full] = np.argmax(signal[starts[full]:])
+    return lows + starts, highs + starts
 
 
 def butter_lowpass(cutoff, fs, order=5):
@@ -10,23 +158,4 @@ def butter_lowpass(cutoff, fs, order=5):
     return b, a
 
 def butter_lowpass_filter(data, cutoff, fs, order=5):
-    b, a = butter_lowpass(cutoff, fs, order=order)
-    y = lfilter(b, a, data)
-    return y
-
-# cutoff=15
-# fs=1000
-#
-# b, a = butter_lowpass(cutoff=15, fs=1000, order=5)
-#
-# # Plot the frequency response.
-# w, h = freqz(b, a, worN=8000)
-# plt.subplot(2, 1, 1)
-# plt.plot(0.5*fs*w/np.pi, np.abs(h), 'b')
-# plt.plot(cutoff, 0.5*np.sqrt(2), 'ko')
-# plt.axvline(cutoff, color='k')
-# plt.xlim(0, 0.5*fs)
-# plt.title("Lowpass Filter Frequency Response")
-# plt.xlabel('Frequency [Hz]')
-# plt.grid()
-# plt.show()
\ No newline at end of file
+    return lowpass(cutoff, fs, order).process(data)
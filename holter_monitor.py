@@ -1,10 +1,15 @@
+import os
 import logging
+import numpy as np
 import argument_parser as ap
 import input_reader as ir
-import waveform_plotter as wp
 import database_manager as dm
 import pvc_detect_two as pvc_detect
+import pvc_stream
+import pvc_parallel
+import ingest
 import holter_monitor_constants as hmc
+import instrumentation as im
 
 args = ap.parse_arguments()
 
@@ -15,16 +20,83 @@ logging.basicConfig(
     level=args.log)
 
 log = logging.getLogger("hm_logger")
+db = dm.get_manager(args.database)
+profiler = im.start_profile() if args.profile else None
 
-if args.upload:
-    time, ecg = ir.read_data(args.upload, args.path)
-    pvcs = pvc_detect.process_data(hmc.SAMPLE_RATE, args.pvc_window, ecg)
-    dm.upload(time, ecg, pvcs)
+if args.convert:
+    ir.convert(args.data, args.convert, args.path,
+               scale=args.adc_scale,
+               block_size=args.block_size or None)
+
+elif args.ingest_dir:
+    ingest.ingest_directory(args.ingest_dir, path=args.database,
+                            workers=args.workers or None,
+                            patient=args.patient,
+                            window=args.pvc_window,
+                            baseline_beats=args.baseline_beats,
+                            detector=args.detector)
+
+elif args.upload:
+    r_peaks = []
+    if args.stream:
+        # the file is read once, its chunks feeding the detector as they
+        # arrive; detection memory is bounded, but the chunks are kept since
+        # the upload still needs the whole recording
+        detector = pvc_stream.StreamingPVCDetector(
+            hmc.SAMPLE_RATE, args.pvc_window,
+            baseline_beats=args.baseline_beats, detector=args.detector,
+            beats=r_peaks)
+        times, chunks, pvcs = [], [], []
+        with im.stage("detect_pvcs", bytes_read=os.path.getsize(
+                ir.file_path(args.path, args.upload))) as record:
+            for time, ecg in ir.read_data(args.upload, args.path,
+                                          chunk_size=hmc.READ_CHUNK_SIZE):
+                times.append(time)
+                chunks.append(ecg)
+                pvcs += detector.process(ecg)
+            pvcs += detector.flush()
+            time, ecg = np.concatenate(times), np.concatenate(chunks)
+            record["samples"] = len(ecg)
+            record["beats"] = len(r_peaks)
+            record["pvcs"] = len(pvcs)
+    else:
+        with im.stage("read_data", bytes_read=os.path.getsize(
+                ir.file_path(args.path, args.upload))) as record:
+            time, ecg = ir.read_data(args.upload, args.path)
+            record["samples"] = len(ecg)
+        with im.stage("detect_pvcs", samples=len(ecg)) as record:
+            if args.workers:
+                pvcs = pvc_parallel.process_parallel(
+                    hmc.SAMPLE_RATE, args.pvc_window, ecg,
+                    workers=args.workers,
+                    baseline_beats=args.baseline_beats,
+                    detector=args.detector, beats=r_peaks)
+            else:
+                pvcs = pvc_detect.process_data(
+                    hmc.SAMPLE_RATE, args.pvc_window, ecg,
+                    plot=args.plot,
+                    baseline_beats=args.baseline_beats,
+                    detector=args.detector,
+                    beats=r_peaks)
+            record["beats"] = len(r_peaks)
+            record["pvcs"] = len(pvcs)
+    with im.stage("upload", samples=len(ecg)):
+        db.upload(time, ecg, pvcs, name=args.upload, patient=args.patient,
+                  content_hash=ir.file_hash(args.upload, args.path),
+                  r_peaks=r_peaks)
 
 else:
+    # the viewer is only imported here so uploads never load bokeh or mpld3
+    import waveform_plotter as wp
+
     # import matplotlib.pyplot as plt
     # plt.plot(data)
     # plt.show()
     # time, ecg = ir.read_data(args.data, args.path)
     # wp.render_pvc_plot(time, ecg, pvcs)
-    wp.render_full_plot()
+    wp.render_full_plot(db=db, recording=args.recording)
+
+if args.metrics:
+    im.write_metrics(args.metrics)
+if profiler is not None:
+    im.stop_profile(profiler, args.profile)
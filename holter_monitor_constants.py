@@ -1,2 +1,42 @@
 SAMPLE_RATE = 1000  # 488
 CUTOFF = 15
+BASELINE_CUTOFF = 0.5  # Hz; high-pass cutoff for baseline wander
+MAINS_FREQUENCY = 60  # Hz
+NOTCH_QUALITY = 30
+BLOCK_SECONDS = 10
+DATABASE_PATH = "hmdata.db"
+POOL_SIZE = 8
+CACHED_STATEMENTS = 64
+QUERY_BATCH_SIZE = 500
+ENVELOPE_LEVELS = (0.01, 0.1, 1, 10, 60, 600)  # seconds per bucket
+ENVELOPE_BLOCK_SIZE = 1024  # buckets per stored blob
+MAX_PLOT_POINTS = 4000
+PLOT_WIDTH = 600  # width of the viewer's figure, in pixels
+POINTS_PER_PIXEL = 2  # a minimum and a maximum per pixel column
+CACHE_BYTES = 268435456  # memory cap of the shared window cache
+CACHE_TILE_SECONDS = 20  # seconds of samples per cached window
+VIEWER_WORKERS = 4  # threads running database queries for viewer sessions
+SUMMARY_BINS = (60, 3600)  # seconds per bin of the stored PVC summaries
+READ_CHUNK_SIZE = 262144  # samples per chunk when streaming files
+TXT_CHUNK_BYTES = 16777216  # bytes per chunk when parsing text logs
+PREMATURITY = .12
+COMPENSATORY = .05
+DISTANCE = .2
+MODE_RESOLUTION = 1e-4  # finest width of a running mode histogram bin
+MODE_BINS = 4096  # most fine bins a running mode histogram keeps
+STREAM_SEGMENT = 60  # seconds of new data per streaming analysis
+STREAM_CONTEXT = 10  # seconds of filtered history kept before each segment
+STREAM_LOOKAHEAD = 3  # seconds after a segment before its peaks are final
+PARALLEL_SEGMENT = 600  # seconds of ecg analyzed by each worker task
+PARALLEL_OVERLAP = 10  # seconds each segment reads past both of its ends
+PARALLEL_MIN_SEGMENT = 60  # seconds; detector thresholds need many beats
+REFRACTORY = .2  # seconds; closer R-peaks from adjacent segments are merged
+QRS_FILTER_BAND = (0.67, 45)  # Hz; band of the filtered signal
+QRS_ENERGY_BAND = (5, 15)  # Hz; band searched for QRS energy
+QRS_INTEGRATION = .15  # seconds of the moving window integral
+QRS_TOLERANCE = .1  # seconds an R-peak may move to the largest deflection
+QRS_SETTLE = .5  # seconds before the levels are learned, while filters settle
+QRS_ARTIFACT = 4  # largest QRS energy, relative to the signal level, learned
+BENCHMARK_HOURS = (1, 6, 24)  # lengths of the synthetic benchmark recordings
+BENCHMARK_QUERIES = 200  # random viewer queries of each kind per benchmark
+MAX_STAGE_RECORDS = 10000  # most timed stages kept for the metrics file
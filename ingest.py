@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import holter_monitor_constants as hmc
+import input_reader as ir
+import database_manager as dm
+import pvc_detect_two as pvc_detect
+import pvc_parallel
+
+log = logging.getLogger("hm_logger")
+
+
+def analyze_file(filename, folder, scratch, known_hashes, window=10,
+                 baseline_beats=0, detector="biosppy"):
+    """ reads one recording and detects its PVCs, in a worker process
+
+    the ecg data is handed back through a .npy file in scratch rather than
+    pickled, and a file whose hash is already known is not read at all
+
+    :param filename: name of the data file
+    :param folder: folder where data files are kept
+    :param scratch: folder for the .npy file
+    :param known_hashes: content hashes of recordings already uploaded
+    :param window: interval for average processing (seconds)
+    :param baseline_beats: if nonzero, beats in the rolling RR baseline
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :return: dictionary with the name and hash of the file, and unless it
+             was skipped, the path of its ecg data, t0, its PVCs and its
+             R-peaks
+    """
+
+    content_hash = ir.file_hash(filename, folder)
+    result = {"name": filename, "hash": content_hash, "ecg_path": None}
+    if content_hash in known_hashes:
+        return result
+
+    time, ecg = ir.read_data(filename, folder)
+    r_peaks = []
+    pvcs = pvc_detect.process_data(hmc.SAMPLE_RATE, window, ecg,
+                                   baseline_beats=baseline_beats,
+                                   detector=detector, beats=r_peaks)
+    result["ecg_path"] = os.path.join(scratch, content_hash + ".npy")
+    np.save(result["ecg_path"], ecg)
+    result["t0"] = float(time[0]) if len(time) > 0 else 0.0
+    result["pvcs"] = pvcs
+    result["r_peaks"] = r_peaks
+    return result
+
+
+def ingest_directory(folder, path=hmc.DATABASE_PATH, workers=None,
+                     patient=None, window=10, baseline_beats=0,
+                     detector="biosppy"):
+    """ uploads every new recording in a folder
+
+    files are read and analyzed by worker processes, and this process is
+    the only one writing to the database, uploading each recording as soon
+    as its worker finishes. Files already uploaded, by content hash, are
+    skipped; files that cannot be read are logged and skipped.
+
+    :param folder: folder holding the data files
+    :param path: path of the database file
+    :param workers: number of worker processes, one per CPU if None
+    :param patient: id of the patient, the name of the folder if None
+    :param window: interval for average processing (seconds)
+    :param baseline_beats: if nonzero, beats in the rolling RR baseline
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :return: lists of (name, recording id) uploaded, names skipped and
+             names that failed
+    """
+
+    folder = os.path.join(folder, "")
+    if patient is None:
+        patient = os.path.basename(os.path.dirname(folder))
+    known = dm.query_hashes(path)
+    names = ir.list_data_files(folder)
+    uploaded, skipped, failed = [], [], []
+
+    scratch = tempfile.mkdtemp(prefix="holter_monitor_")
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=pvc_parallel.pool_context()) as executor:
+            futures = dict((executor.submit(analyze_file, name, folder,
+                                            scratch, known, window,
+                                            baseline_beats, detector), name)
+                           for name in names)
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.error("could not ingest {0}: {1}".format(name, e))
+                    failed.append(name)
+                    continue
+                # duplicates within the batch are caught here
+                if result["ecg_path"] is None or result["hash"] in known:
+                    skipped.append(name)
+                    continue
+
+                ecg = np.load(result["ecg_path"], mmap_mode="r")
+                try:
+                    recording = dm.upload(
+                        ir.SampleTimes(len(ecg), hmc.SAMPLE_RATE,
+                                       result["t0"]),
+                        ecg, result["pvcs"], path=path, name=name,
+                        patient=patient, content_hash=result["hash"],
+                        r_peaks=result["r_peaks"])
+                except Exception as e:
+                    # the upload was rolled back, so the next file can go on
+                    log.error("could not upload {0}: {1}".format(name, e))
+                    failed.append(name)
+                    continue
+                finally:
+                    del ecg
+                    os.remove(result["ecg_path"])
+                known.add(result["hash"])
+                uploaded.append((name, recording))
+    finally:
+        shutil.rmtree(scratch)
+
+    log.info("ingested {0}: {1} uploaded, {2} already uploaded, {3} failed"
+             .format(folder, len(uploaded), len(skipped), len(failed)))
+    return uploaded, skipped, failed
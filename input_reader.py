@@ -1,12 +1,51 @@
 import holter_monitor_errors as hme
 import holter_monitor_constants as hmc
 import numpy as np
-import lvm_read as lr
 import nptdms as npt
 import os.path
+import itertools
+import json
+import struct
+import zlib
+import hashlib
 import logging
+import warnings
 log = logging.getLogger("hm_logger")
 
+NATIVE_EXTENSION = ".hmr"
+NATIVE_MAGIC = b"HMREC\x00\x00\x01"
+DATA_EXTENSIONS = (NATIVE_EXTENSION, ".lvm", ".npy", ".tdms", ".txt")
+
+
+class SampleTimes(object):
+    """ time axis of a uniformly sampled recording, derived on demand from
+    the sample rate instead of being stored alongside the samples
+
+    """
+
+    def __init__(self, num_samples, sample_rate=hmc.SAMPLE_RATE, t0=0.0):
+        self.num_samples = num_samples
+        self.sample_rate = sample_rate
+        self.t0 = t0
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.t0 + \
+                np.arange(*key.indices(self.num_samples)) / self.sample_rate
+        if np.ndim(key) > 0:
+            return self.t0 + np.asarray(key) / self.sample_rate
+        if key < 0:
+            key += self.num_samples
+        if not 0 <= key < self.num_samples:
+            raise IndexError("sample index out of range")
+        return self.t0 + key / self.sample_rate
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype) if dtype is not None else self[:]
+
 
 def read_tdms(filename="ecg.tdms", folder="data/",
               sample_rate=hmc.SAMPLE_RATE,
@@ -29,18 +68,100 @@ def read_tdms(filename="ecg.tdms", folder="data/",
 
     file = npt.TdmsFile(file_path(folder, filename))
     ecg = file.object(group_name, channel_name).data
-    num_samples = len(ecg)
-    num_seconds = num_samples / sample_rate
-    time = np.linspace(0, num_seconds, num_samples)
-    return time, ecg
+    return SampleTimes(len(ecg), sample_rate), ecg
 
 
-def read_lvm(filename="ecg.lvm", folder="data/"):
-    """ reads ecg data from an LabView (.lvm) file
+def read_lvm_header(f):
+    """ parses the file and segment headers at the top of an LabView file
+
+    leaves f positioned at the first row of samples
+
+    :param f: LabView (.lvm) file opened in text mode
+    :return: dictionary with the channel count, X0, Delta_X, column layout
+             and separators of the first segment
+    """
+
+    header = {}
+    ends = 0
+    for line in f:
+        fields = line.rstrip("\r\n").split("\t")
+        if fields[0] == "***End_of_Header***":
+            ends += 1
+            if ends == 2:
+                break
+        elif len(fields) > 1:
+            header[fields[0]] = fields[1:]
+    else:
+        message = "no segment header found in " + f.name
+        log.error(message)
+        raise hme.InvalidFormatError(message)
+
+    columns_line = f.readline()
+    try:
+        channels = int(header["Channels"][0])
+        decimal = header.get("Decimal_Separator", ["."])[0] or "."
+        x0 = float(header["X0"][0].replace(decimal, "."))
+        delta_x = float(header["Delta_X"][0].replace(decimal, "."))
+    except (KeyError, IndexError, ValueError):
+        message = "incomplete LabView segment header in " + f.name
+        log.error(message)
+        raise hme.DataFormatError(message)
+
+    x_columns = header.get("X_Columns", ["One"])[0]
+    x_count = {"No": 0, "One": 1, "Multi": channels}.get(x_columns, 1)
+    return {
+        "channels": channels,
+        "x0": x0,
+        "delta_x": delta_x,
+        "x_columns": x_columns,
+        "columns": x_count + channels,
+        "separator": header.get("Separator", ["Tab"])[0],
+        "decimal_separator": decimal,
+        "column_names": columns_line.rstrip("\r\n").split("\t"),
+    }
+
+
+def parse_lvm_rows(lines, header, filename):
+    """ parses a block of LabView sample rows into a 2D array
+
+    :param lines: list of sample rows as text
+    :param header: header dictionary from read_lvm_header
+    :param filename: name of the file, for error messages
+    :return: (len(lines), columns) array of samples
+    """
+
+    text = "".join(lines)
+    if header["separator"] == "Comma":
+        text = text.replace(",", " ")
+    if header["decimal_separator"] != ".":
+        text = text.replace(header["decimal_separator"], ".")
+    columns = header["columns"]
+    fields = text.split()
+    try:
+        if len(fields) != len(lines) * columns:
+            raise ValueError("expected {0} values per row".format(columns))
+        values = np.array(fields, dtype=np.float64)
+    except ValueError:
+        if any(line.startswith("***End_of_Header***") for line in lines):
+            message = "multiple segments detected in " + filename
+        else:
+            message = "malformed sample rows in " + filename
+        log.error(message)
+        raise hme.InvalidFormatError(message)
+    return values.reshape(len(lines), columns)
+
+
+def iter_lvm(filename="ecg.lvm", folder="data/",
+             chunk_size=hmc.READ_CHUNK_SIZE,
+             channel=0):
+    """ reads ecg data from an LabView (.lvm) file in fixed-size chunks, so
+    that memory use does not depend on the length of the file
 
     :param filename: name of lvm file
     :param folder: folder where data files are kept
-    :return: time data array, ecg data array
+    :param chunk_size: number of samples per chunk
+    :param channel: zero-based index of the channel to read
+    :return: generator of (time, ecg) data array chunks
     """
 
     extension = os.path.splitext(filename)[1]
@@ -48,24 +169,65 @@ def read_lvm(filename="ecg.lvm", folder="data/"):
         message = filename + " was not a LabView file"
         log.error(message)
         raise hme.InvalidFormatError(message)
-    data = lr.read(file_path(folder, filename))
 
-    if data["Segments"] != 1:
-        message = "multiple segments detected in " + filename
-        log.error(message)
-        raise hme.InvalidFormatError(message)
+    with open(file_path(folder, filename)) as f:
+        header = read_lvm_header(f)
+        if channel >= header["channels"]:
+            message = "channel {0} not found in {1}".format(channel, filename)
+            log.error(message)
+            raise hme.MissingDataError(message)
 
-    arr = data[0]['data']
-    ecg = arr[:, 1]
-    time = arr[:, 0]
+        x_count = header["columns"] - header["channels"]
+        ecg_column = channel * 2 + 1 if header["x_columns"] == "Multi" \
+            else x_count + channel
+        sample = 0
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            # tolerate blank trailing lines at the end of the file
+            lines = [line for line in lines if line.strip()]
+            if len(lines) == 0:
+                return
+            rows = parse_lvm_rows(lines, header, filename)
+            ecg = rows[:, ecg_column]
+            if x_count > 0:
+                time = rows[:, ecg_column - 1 if x_count > 1 else 0]
+            else:
+                time = header["x0"] + header["delta_x"] * \
+                    np.arange(sample, sample + len(rows))
+            sample += len(rows)
+            yield time, ecg
+
+
+def read_lvm(filename="ecg.lvm", folder="data/"):
+    """ reads ecg data from an LabView (.lvm) file
+
+    :param filename: name of lvm file
+    :param folder: folder where data files are kept
+    :return: time data array, ecg data array
+    """
+
+    chunks = list(iter_lvm(filename, folder))
+    if len(chunks) == 0:
+        return np.array([]), np.array([])
+    time = np.concatenate([t for (t, e) in chunks])
+    ecg = np.concatenate([e for (t, e) in chunks])
     return time, ecg
 
 
-def read_bin(filename="ecg.npy", folder="data/"):
+def read_bin(filename="ecg.npy", folder="data/",
+             sample_rate=hmc.SAMPLE_RATE,
+             mmap_mode="r"):
     """ reads ecg data from a NumPy (.npy) binary file
 
+    the file is memory-mapped, so slices of the returned ecg array are only
+    read from disk when they are used.  Files written by save_binary hold
+    a single float32 ecg column and time is derived from the sample rate;
+    older files with an (N, 2) time/ecg layout are still supported
+
     :param filename: name of binary file
     :param folder: folder where data files are kept
+    :param sample_rate: sampling rate of single-column files
+    :param mmap_mode: mode passed to np.load, or None to load eagerly
     :return: time data array, ecg data array
     """
 
@@ -74,53 +236,516 @@ def read_bin(filename="ecg.npy", folder="data/"):
         message = filename + " was not a NumPy binary file"
         log.error(message)
         raise hme.InvalidFormatError(message)
-    data = np.load(file_path(folder, filename))
+    data = np.load(file_path(folder, filename), mmap_mode=mmap_mode)
+    if data.ndim == 1:
+        return SampleTimes(len(data), sample_rate), data
     time = data[:, 0]
     ecg = data[:, 1]
     return time, ecg
 
 
+def count_rows(view):
+    """ counts the rows of a buffer that are not empty
+
+    a row holding only "\r", as written on Windows, is empty too; rows of
+    other whitespace are counted
+
+    :param view: uint8 array of whole lines
+    :return: number of rows
+    """
+
+    newline = view == ord("\n")
+    rows = np.count_nonzero(newline)
+    if len(view) > 0 and not newline[-1]:
+        rows += 1
+    # "\n" at the start or after another "\n" ends an empty row
+    blank = np.count_nonzero(newline[1:] & newline[:-1])
+    carriage = view[1:-1] == ord("\r")
+    blank += np.count_nonzero(newline[2:] & carriage & newline[:-2])
+    if len(view) > 0 and newline[0]:
+        blank += 1
+    if len(view) > 1 and view[0] == ord("\r") and newline[1]:
+        blank += 1
+    return rows - blank
+
+
+def parse_txt_chunk(chunk, filename):
+    """ parses a buffer of whole integer-per-line rows in bulk
+
+    values are parsed by numpy in one call; a row holding more than one
+    value, such as "2 3", would shift every later timestamp, so the number
+    of values must match the number of rows
+
+    :param chunk: bytes-like buffer ending at a line boundary
+    :param filename: name of the file, for error messages
+    :return: int32 array with one value per non-blank line
+    """
+
+    view = np.frombuffer(chunk, dtype=np.uint8)
+    try:
+        with warnings.catch_warnings():
+            # older numpy warns and stops at the first value it cannot read
+            warnings.simplefilter("error", DeprecationWarning)
+            values = np.fromstring(view, dtype=np.int64, sep=" ")
+        rows = count_rows(view)
+        if len(values) != rows or np.any((view == ord(" ")) |
+                                         (view == ord("\t"))):
+            # a row of spaces or tabs may be blank, or hold two values, so
+            # such rows are rare enough to be checked one by one
+            rows = sum(1 for row in bytes(chunk).split(b"\n") if row.strip())
+        if len(values) != rows:
+            raise ValueError("more than one value on a row")
+        if len(values) > 0 and (values.min() < np.iinfo(np.int32).min or
+                                values.max() > np.iinfo(np.int32).max):
+            raise ValueError("value out of range")
+    except (ValueError, DeprecationWarning):
+        message = "non-integer rows found in " + filename
+        log.error(message)
+        raise hme.DataFormatError(message)
+    return values.astype(np.int32)
+
+
+def iter_txt_chunks(path, chunk_bytes=hmc.TXT_CHUNK_BYTES, use_mmap=False):
+    """ splits a text file into buffers of whole lines
+
+    :param path: path of the text file
+    :param chunk_bytes: approximate size of each buffer, in bytes
+    :param use_mmap: memory-map the file instead of reading it
+    :return: generator of bytes-like buffers ending at line boundaries
+    """
+
+    if use_mmap:
+        if os.path.getsize(path) == 0:
+            return
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+        start = 0
+        while start < len(buf):
+            end = min(start + chunk_bytes, len(buf))
+            # extend the chunk to the end of its last line
+            while end < len(buf) and buf[end - 1] != ord("\n"):
+                newline = np.flatnonzero(buf[end:end + 4096] == ord("\n"))
+                end = end + newline[0] + 1 if len(newline) > 0 \
+                    else min(end + 4096, len(buf))
+            yield buf[start:end]
+            start = end
+        return
+
+    with open(path, "rb") as f:
+        leftover = b""
+        while True:
+            data = f.read(chunk_bytes)
+            if len(data) == 0:
+                break
+            data = leftover + data
+            newline = data.rfind(b"\n") + 1
+            if newline == 0:
+                leftover = data
+                continue
+            leftover = data[newline:]
+            yield data[:newline]
+        if len(leftover) > 0:
+            yield leftover
+
+
+def adc_to_volts(counts, scale=None, offset=0.0):
+    """ converts raw ADC counts from the memory system into volts
+
+    :param counts: array of ADC counts
+    :param scale: volts per ADC count, or None to keep raw counts
+    :param offset: volts added after scaling
+    :return: ecg data array
+    """
+
+    if scale is None:
+        return counts
+    return counts.astype("float32") * np.float32(scale) + np.float32(offset)
+
+
+def iter_txt(filename="ecg.txt", folder="data/",
+             sample_rate=hmc.SAMPLE_RATE,
+             scale=None,
+             offset=0.0,
+             chunk_bytes=hmc.TXT_CHUNK_BYTES,
+             use_mmap=False):
+    """ reads ecg data from a memory system text file in chunks
+
+    :param filename: name of .txt file
+    :param folder: folder where data files are kept
+    :param sample_rate: sampling rate of the data
+    :param scale: volts per ADC count, or None to keep raw counts
+    :param offset: volts added after scaling
+    :param chunk_bytes: approximate size of each chunk, in bytes
+    :param use_mmap: memory-map the file instead of reading it
+    :return: generator of (time, ecg) data array chunks
+    """
+
+    extension = os.path.splitext(filename)[1]
+    if extension.lower() != ".txt":
+        message = filename + " was not a .txt file"
+        log.error(message)
+        raise hme.InvalidFormatError(message)
+
+    sample = 0
+    for chunk in iter_txt_chunks(file_path(folder, filename),
+                                 chunk_bytes, use_mmap):
+        counts = parse_txt_chunk(chunk, filename)
+        time = np.arange(sample, sample + len(counts)) / sample_rate
+        sample += len(counts)
+        yield time, adc_to_volts(counts, scale, offset)
+
+
 def read_txt(filename="ecg.txt", folder="data/",
-             sample_rate=hmc.SAMPLE_RATE):
+             sample_rate=hmc.SAMPLE_RATE,
+             scale=None,
+             offset=0.0,
+             use_mmap=False):
     """ reads ecg data from a text file generated using the memory system
     
     :param filename: name of .txt file
     :param folder: folder where data files are kept
     :param sample_rate: sampling rate of the data
+    :param scale: volts per ADC count, or None to keep raw counts
+    :param offset: volts added after scaling
+    :param use_mmap: memory-map the file instead of reading it
     :return: time data array, ecg data array
     """
 
     extension = os.path.splitext(filename)[1]
-    if extension != ".txt":
+    if extension.lower() != ".txt":
         message = filename + " was not a .txt file"
         log.error(message)
         raise hme.InvalidFormatError(message)
-    with open(file_path(folder, filename)) as f:
-        lines = f.read().splitlines()
-        ecg = np.array([int(i) for i in lines])
-        num_samples = len(ecg)
-        num_seconds = num_samples / sample_rate
-        time = np.linspace(0, num_seconds, num_samples)
-        return time, ecg
+
+    chunks = [parse_txt_chunk(chunk, filename) for chunk in iter_txt_chunks(
+        file_path(folder, filename), use_mmap=use_mmap)]
+    counts = np.concatenate(chunks) if len(chunks) > 0 \
+        else np.array([], dtype=np.int32)
+    return SampleTimes(len(counts), sample_rate), \
+        adc_to_volts(counts, scale, offset)
+
+
+def save_native(chunks, output_filename, folder="data/",
+                sample_rate=hmc.SAMPLE_RATE,
+                t0=0.0,
+                units="Volts",
+                channel_names=("ECG",),
+                dtype="float32",
+                scale=None,
+                offset=0.0,
+                block_size=None):
+    """ writes ecg data in the Holter Monitor recording (.hmr) format
+
+    the file is the magic bytes, the sample body and a JSON footer holding
+    the sample rate, t0, units and channel names.  The body is either one
+    contiguous (samples, channels) array that can be memory-mapped, or
+    zlib-compressed blocks of block_size samples with an offset index
+
+    :param chunks: iterable of ecg data arrays, (n,) or (n, channels)
+    :param output_filename: name of the .hmr file to write
+    :param folder: folder where data files are kept
+    :param sample_rate: sampling rate of the data
+    :param t0: time of the first sample, in seconds
+    :param units: units of the stored samples after scaling
+    :param channel_names: name of each channel
+    :param dtype: "float32", or "int16" to store scaled integer counts
+    :param scale: units per int16 count, required for "int16"
+    :param offset: units added to int16 counts after scaling
+    :param block_size: samples per compressed block, or None to store the
+                       body uncompressed
+    """
+
+    extension = os.path.splitext(output_filename)[1]
+    if extension != NATIVE_EXTENSION:
+        message = "output file is not a " + NATIVE_EXTENSION + " file"
+        log.error(message)
+        raise hme.InvalidFormatError(message)
+    if dtype not in ("float32", "int16") or \
+            (dtype == "int16" and scale is None):
+        message = "int16 recordings need a scale, float32 ones do not"
+        log.error(message)
+        raise hme.InputError(message)
+
+    channels = len(channel_names)
+    stored_dtype = np.dtype(dtype).newbyteorder("<")
+    num_samples = 0
+    offsets = []
+    pending = []
+
+    clipped = [0]
+
+    def encode(samples):
+        samples = np.asarray(samples).reshape(-1, channels)
+        if dtype == "int16":
+            counts = np.round((samples - offset) / scale)
+            samples = np.clip(counts, -32768, 32767)
+            clipped[0] += np.count_nonzero(samples != counts)
+        return np.ascontiguousarray(samples, dtype=stored_dtype)
+
+    def write_block(f, samples):
+        offsets.append(f.tell())
+        f.write(zlib.compress(samples.tobytes()))
+
+    with open(file_path(folder, output_filename), "wb") as f:
+        f.write(NATIVE_MAGIC)
+        for chunk in chunks:
+            samples = encode(chunk)
+            num_samples += len(samples)
+            if block_size is None:
+                f.write(samples.tobytes())
+                continue
+            pending.append(samples)
+            buffered = np.concatenate(pending)
+            full = len(buffered) - len(buffered) % block_size
+            for start in range(0, full, block_size):
+                write_block(f, buffered[start:start + block_size])
+            pending = [buffered[full:]]
+        if block_size is not None and sum(len(p) for p in pending) > 0:
+            write_block(f, np.concatenate(pending))
+
+        index_offset = f.tell()
+        if block_size is not None:
+            offsets.append(index_offset)
+            f.write(np.array(offsets, dtype="<u8").tobytes())
+
+        header = {
+            "version": 1,
+            "sample_rate": float(sample_rate),
+            "t0": float(t0),
+            "units": units,
+            "channel_names": list(channel_names),
+            "dtype": dtype,
+            "scale": scale,
+            "offset": float(offset),
+            "num_samples": num_samples,
+            "data_offset": len(NATIVE_MAGIC),
+            "block_size": block_size,
+            "compression": None if block_size is None else "zlib",
+            "index_offset": index_offset,
+        }
+        footer = json.dumps(header).encode("utf-8")
+        if clipped[0] > 0:
+            log.warning("{0} samples clipped to the int16 range in {1}"
+                        .format(clipped[0], output_filename))
+        f.write(footer)
+        f.write(struct.pack("<Q", len(footer)))
+
+
+def read_native_header(path):
+    """ reads the JSON footer of a Holter Monitor recording (.hmr) file
+
+    :param path: path of the .hmr file
+    :return: dictionary of recording metadata
+    """
+
+    with open(path, "rb") as f:
+        magic = f.read(len(NATIVE_MAGIC))
+        size = os.fstat(f.fileno()).st_size
+        # the magic and the footer length must both fit before seeking back
+        # from the end, or a short file would seek before its start
+        if magic != NATIVE_MAGIC or size < len(NATIVE_MAGIC) + 8:
+            message = path + " is not a Holter Monitor recording"
+            log.error(message)
+            raise hme.InvalidFormatError(message)
+        f.seek(-8, os.SEEK_END)
+        footer_length = struct.unpack("<Q", f.read(8))[0]
+        if footer_length > size - len(NATIVE_MAGIC) - 8:
+            message = "footer of " + path + " is truncated"
+            log.error(message)
+            raise hme.InvalidFormatError(message)
+        f.seek(-8 - footer_length, os.SEEK_END)
+        footer = f.read(footer_length)
+    try:
+        return json.loads(footer.decode("utf-8"))
+    except ValueError:
+        message = "footer of " + path + " is not valid JSON"
+        log.error(message)
+        raise hme.InvalidFormatError(message)
+
+
+def read_native_range(filename="ecg.hmr", folder="data/",
+                      start=0, end=None, channel=0):
+    """ reads samples [start, end) of a Holter Monitor recording (.hmr)
+    without scanning the rest of the file
+
+    :param filename: name of .hmr file
+    :param folder: folder where data files are kept
+    :param start: index of the first sample
+    :param end: index one past the last sample, or None for the end
+    :param channel: zero-based index of the channel to read
+    :return: time data array, ecg data array
+    """
+
+    path = file_path(folder, filename)
+    header = read_native_header(path)
+    num_samples = header["num_samples"]
+    channels = len(header["channel_names"])
+    dtype = np.dtype(header["dtype"]).newbyteorder("<")
+    start = min(max(start, 0), num_samples)
+    end = num_samples if end is None else min(max(end, start), num_samples)
+
+    if header["block_size"] is None:
+        body = np.memmap(path, dtype=dtype, mode="r",
+                         offset=header["data_offset"],
+                         shape=(num_samples, channels))
+        samples = body[start:end, channel]
+    else:
+        block_size = header["block_size"]
+        first_block = start // block_size
+        last_block = -(-end // block_size)
+        offsets = np.memmap(path, dtype="<u8", mode="r",
+                            offset=header["index_offset"],
+                            shape=(-(-num_samples // block_size) + 1,))
+        blocks = []
+        with open(path, "rb") as f:
+            for block in range(first_block, last_block):
+                f.seek(int(offsets[block]))
+                data = f.read(int(offsets[block + 1] - offsets[block]))
+                blocks.append(np.frombuffer(zlib.decompress(data),
+                                            dtype=dtype).reshape(-1, channels))
+        buffered = np.concatenate(blocks) if len(blocks) > 0 \
+            else np.empty((0, channels), dtype=dtype)
+        skip = start - first_block * block_size
+        samples = buffered[skip:skip + end - start, channel]
+
+    if header["dtype"] == "int16":
+        samples = adc_to_volts(samples, header["scale"], header["offset"])
+    time = header["t0"] + np.arange(start, end) / header["sample_rate"]
+    return time, samples
+
+
+def read_native(filename="ecg.hmr", folder="data/", channel=0):
+    """ reads ecg data from a Holter Monitor recording (.hmr) file
+
+    uncompressed float32 recordings are memory-mapped rather than loaded
+
+    :param filename: name of .hmr file
+    :param folder: folder where data files are kept
+    :param channel: zero-based index of the channel to read
+    :return: time data array, ecg data array
+    """
+
+    extension = os.path.splitext(filename)[1]
+    if extension != NATIVE_EXTENSION:
+        message = filename + " was not a Holter Monitor recording"
+        log.error(message)
+        raise hme.InvalidFormatError(message)
+
+    header = read_native_header(file_path(folder, filename))
+    time, ecg = read_native_range(filename, folder, channel=channel)
+    return SampleTimes(header["num_samples"], header["sample_rate"],
+                       header["t0"]), ecg
+
+
+def iter_native(filename="ecg.hmr", folder="data/",
+                chunk_size=hmc.READ_CHUNK_SIZE,
+                channel=0):
+    """ reads ecg data from a Holter Monitor recording (.hmr) in chunks
+
+    :param filename: name of .hmr file
+    :param folder: folder where data files are kept
+    :param chunk_size: number of samples per chunk
+    :param channel: zero-based index of the channel to read
+    :return: generator of (time, ecg) data array chunks
+    """
+
+    header = read_native_header(file_path(folder, filename))
+    for start in range(0, header["num_samples"], chunk_size):
+        yield read_native_range(filename, folder, start,
+                                start + chunk_size, channel)
+
+
+def sample_rate_of(time):
+    """ sampling rate implied by the sample times of a chunk
+
+    :param time: time data array, or SampleTimes
+    :return: samples per second, or None if time has fewer than two samples
+    """
+
+    if isinstance(time, SampleTimes):
+        return time.sample_rate
+    if len(time) < 2:
+        return None
+    # times may be float32 or written with few digits, so the rate is taken
+    # over the whole chunk rather than from neighbouring samples
+    span = float(time[-1]) - float(time[0])
+    if span <= 0:
+        return None
+    return float(np.round((len(time) - 1) / span, 3))
+
+
+def convert(input_filename, output_filename, folder="data/",
+            sample_rate=None,
+            scale=None,
+            block_size=None):
+    """ converts an LVM, TDMS, TXT or NPY recording into the compact
+    Holter Monitor recording (.hmr) format, streaming where the input
+    format allows it
+
+    :param input_filename: name of the file to convert
+    :param output_filename: name of the .hmr file to write
+    :param folder: folder where data files are kept
+    :param sample_rate: sampling rate of the data, or None to take it from
+                        the spacing of the input's sample times
+    :param scale: if given, store int16 counts of this many volts each
+    :param block_size: samples per compressed block, or None to store the
+                       body uncompressed
+    """
+
+    chunks = iter_data(input_filename, folder)
+    first = next(chunks, None)
+    t0 = float(first[0][0]) if first is not None and len(first[0]) > 0 \
+        else 0.0
+    if sample_rate is None:
+        sample_rate = (sample_rate_of(first[0]) if first is not None
+                       else None) or hmc.SAMPLE_RATE
+    ecg_chunks = itertools.chain(
+        [] if first is None else [first[1]],
+        (ecg for (time, ecg) in chunks))
+    save_native(ecg_chunks, output_filename, folder,
+                sample_rate=sample_rate,
+                t0=t0,
+                dtype="float32" if scale is None else "int16",
+                scale=scale,
+                block_size=block_size)
+    log.debug("converted " + input_filename + " to " + output_filename)
 
 
 def read_data(data_filename="ecg.lvm",
-              folder="data/"):
+              folder="data/",
+              chunk_size=None,
+              sample_range=None):
     """ Read data from a file
 
-    :param data_filename: name of npy or lvm file
+    :param data_filename: name of hmr, npy, lvm, tdms or txt file
     :param folder: folder where data files are kept
+    :param chunk_size: if given, return an iterator of (time, ecg) chunks of
+                       this many samples instead of the full arrays
+    :param sample_range: if given, only read samples [start, end); hmr and
+                         npy files are read without scanning the file
     :return: time data array, ecg data array
     """
 
     extension = os.path.splitext(data_filename)[1]
-    if extension == ".lvm":
+    if chunk_size is not None:
+        return iter_data(data_filename, folder, chunk_size)
+
+    if sample_range is not None and extension == NATIVE_EXTENSION:
+        time, ecg = read_native_range(data_filename, folder, *sample_range)
+        return time.astype("float32"), ecg.astype("float32", copy=False)
+    if sample_range is not None:
+        time, ecg = read_data(data_filename, folder)
+        start, end = sample_range
+        return np.asarray(time[start:end], dtype="float32"), ecg[start:end]
+
+    if extension == NATIVE_EXTENSION:
+        time, ecg = read_native(data_filename, folder)
+    elif extension == ".lvm":
         time, ecg = read_lvm(data_filename, folder)
     elif extension == ".npy":
         time, ecg = read_bin(data_filename, folder)
     elif extension == ".tdms":
         time, ecg = read_tdms(data_filename, folder)
-    elif extension == ".txt":
+    elif extension.lower() == ".txt":
         time, ecg = read_txt(data_filename, folder)
     else:
         message = extension + " files are not supported yet"
@@ -130,7 +755,88 @@ def read_data(data_filename="ecg.lvm",
     log.debug("successfully read and constructed ecg data from " +
               data_filename)
 
-    return time.astype("float32"), ecg.astype("float32")
+    # copy=False keeps memory-mapped float32 recordings zero-copy
+    if isinstance(time, np.ndarray):
+        time = time.astype("float32", copy=False)
+    return time, ecg.astype("float32", copy=False)
+
+
+def iter_data(data_filename="ecg.lvm",
+              folder="data/",
+              chunk_size=hmc.READ_CHUNK_SIZE):
+    """ Read data from a file as a stream of fixed-size chunks
+
+    :param data_filename: name of npy or lvm file
+    :param folder: folder where data files are kept
+    :param chunk_size: number of samples per chunk
+    :return: generator of (time, ecg) data array chunks
+    """
+
+    extension = os.path.splitext(data_filename)[1]
+    if extension == NATIVE_EXTENSION:
+        chunks = iter_native(data_filename, folder, chunk_size)
+    elif extension == ".lvm":
+        chunks = iter_lvm(data_filename, folder, chunk_size)
+    elif extension.lower() == ".txt":
+        chunks = rechunk(iter_txt(data_filename, folder), chunk_size)
+    else:
+        all_time, all_ecg = read_data(data_filename, folder)
+        chunks = ((all_time[i:i + chunk_size], all_ecg[i:i + chunk_size])
+                  for i in range(0, len(all_ecg), chunk_size))
+
+    for time, ecg in chunks:
+        yield time.astype("float32"), ecg.astype("float32", copy=False)
+
+
+def rechunk(chunks, chunk_size):
+    """ regroups a stream of (time, ecg) chunks into chunks of a fixed size
+
+    :param chunks: iterable of (time, ecg) data array chunks
+    :param chunk_size: number of samples per output chunk
+    :return: generator of (time, ecg) data array chunks
+    """
+
+    times, ecgs, buffered = [], [], 0
+    for time, ecg in chunks:
+        times.append(time)
+        ecgs.append(ecg)
+        buffered += len(ecg)
+        while buffered >= chunk_size:
+            time, ecg = np.concatenate(times), np.concatenate(ecgs)
+            yield time[:chunk_size], ecg[:chunk_size]
+            times, ecgs = [time[chunk_size:]], [ecg[chunk_size:]]
+            buffered -= chunk_size
+    if buffered > 0:
+        yield np.concatenate(times), np.concatenate(ecgs)
+
+
+def list_data_files(folder="data/"):
+    """ lists the files in a folder that read_data can read
+
+    :param folder: folder where data files are kept
+    :return: sorted list of file names
+    """
+
+    return sorted(name for name in os.listdir(folder)
+                  if os.path.splitext(name)[1].lower() in DATA_EXTENSIONS and
+                  os.path.isfile(os.path.join(folder, name)))
+
+
+def file_hash(filename, folder="data/", chunk_bytes=hmc.TXT_CHUNK_BYTES):
+    """ hashes the contents of a data file, so a recording is recognized
+    whatever it is named
+
+    :param filename: name of the data file
+    :param folder: folder where data files are kept
+    :param chunk_bytes: number of bytes read at a time
+    :return: hex SHA-256 digest
+    """
+
+    digest = hashlib.sha256()
+    with open(file_path(folder, filename), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def file_path(folder, filename):
@@ -145,6 +851,14 @@ def file_path(folder, filename):
 
 
 def save_binary(data, input_filename, output_filename, folder="data/"):
+    """ saves ecg data as a single float32 column that read_bin can map
+
+    :param data: ecg data array, or an (N, 2) time/ecg array
+    :param input_filename: name of the file the data was read from
+    :param output_filename: name of the .npy file to write
+    :param folder: folder where data files are kept
+    """
+
     input_extension = os.path.splitext(input_filename)[1]
     if input_extension == ".npy":
         message = "input file was already a NumPy binary file"
@@ -155,6 +869,8 @@ def save_binary(data, input_filename, output_filename, folder="data/"):
         message = "output file is not a NumPy binary file"
         log.error(message)
         raise hme.InvalidFormatError(message)
+    data = np.asarray(data)
+    ecg = data[:, 1] if data.ndim == 2 else data
     output_file = open(file_path(folder, output_filename), 'wb')
-    np.save(output_file, data)
+    np.save(output_file, np.ascontiguousarray(ecg, dtype="float32"))
     output_file.close()
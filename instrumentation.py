@@ -0,0 +1,112 @@
+import sys
+import json
+import time as tm
+import pstats
+import cProfile
+import contextlib
+import collections
+import logging
+from io import StringIO
+import holter_monitor_constants as hmc
+
+try:
+    import resource
+except ImportError:
+    # Unix only; elsewhere stages are timed without measuring memory
+    resource = None
+
+log = logging.getLogger("hm_logger")
+
+# the latest finished stages of this run, in the order they finished; long
+# runs such as ingesting a folder keep only the most recent ones
+records = collections.deque(maxlen=hmc.MAX_STAGE_RECORDS)
+
+# keys of a record that are measured rather than counted
+TIMINGS = ("stage", "seconds", "peak_rss_mb", "rss_growth_mb",
+           "samples_per_second")
+
+
+def peak_rss():
+    """ largest resident set size of this process so far, in megabytes
+
+    :return: peak memory, or None where it cannot be measured
+    """
+
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return usage / 2.0 ** 20 if sys.platform == "darwin" else usage / 1024.0
+
+
+@contextlib.contextmanager
+def stage(name, **counts):
+    """ times a stage of the pipeline and logs what it did
+
+    counts such as samples, bytes_read or rows_written can be passed in, or
+    set on the yielded record once they are known. Peak memory is the
+    process's high-water mark when the stage ends, and rss_growth_mb how
+    much the stage raised it.
+
+    :param name: name of the stage
+    :param counts: initial counts of the stage
+    :return: context manager yielding the record of the stage, a dictionary
+    """
+
+    record = {"stage": name}
+    record.update(counts)
+    start_rss = peak_rss()
+    start = tm.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = tm.perf_counter() - start
+        record["peak_rss_mb"] = peak_rss()
+        if start_rss is not None:
+            record["rss_growth_mb"] = record["peak_rss_mb"] - start_rss
+        if record["seconds"] > 0 and "samples" in record:
+            record["samples_per_second"] = \
+                record["samples"] / record["seconds"]
+        records.append(record)
+        log.debug("{0}: {1:.3f}s{2}{3}".format(
+            name, record["seconds"],
+            "" if start_rss is None else
+            ", peak memory {0:.0f} MB".format(record["peak_rss_mb"]),
+            "".join(", {0}={1}".format(key, record[key])
+                    for key in sorted(record) if key not in TIMINGS)))
+
+
+def write_metrics(path):
+    """ writes the recorded stages to a JSON file and forgets them
+
+    :param path: path of the metrics file
+    """
+
+    with open(path, "w") as f:
+        json.dump({"stages": list(records)}, f, indent=2)
+    log.info("wrote metrics of {0} stages to {1}".format(len(records), path))
+    records.clear()
+
+
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, path, top=25):
+    """ stops a profiler, dumps its statistics and logs the slowest calls
+
+    :param profiler: cProfile.Profile returned by start_profile
+    :param path: path of the file the statistics are dumped to, readable
+                 with pstats or snakeviz
+    :param top: number of functions to log, by cumulative time
+    """
+
+    profiler.disable()
+    profiler.dump_stats(path)
+    stream = StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats(
+        "cumulative").print_stats(top)
+    log.debug("profile of the run, saved to {0}:\n{1}".format(
+        path, stream.getvalue()))
@@ -1,14 +1,21 @@
-import holter_monitor_errors as hme
 import holter_monitor_constants as hmc
 import numpy as np
-import lvm_read as lr
 import os.path
-from biosppy.signals import ecg
-import matplotlib.pyplot as plt
-from input_reader import file_path
-import array
-import sys
+import logging
+import heapq as hq
+from collections import namedtuple
+import input_reader as ir
+import qrs_detect
 import filter_functions as ff
+import instrumentation as im
+
+log = logging.getLogger("hm_logger")
+
+# tiers[k] holds the R-peaks that met k + 1 of the PVC criteria, and indexes
+# is None when averages holds a rolling baseline for every RR interval
+Detection = namedtuple("Detection", ["lpf_signal", "filtered", "r_peaks",
+                                     "distances", "r_peak_times", "indexes",
+                                     "averages", "mode", "tiers"])
 
 
 def get_signal_data(fs, window, filename):
@@ -34,53 +41,185 @@ def get_distances(r_peaks, fs):
 
     :param r_peaks: data point locations of R-peaks
     :param fs: sampling frequency of data
-    :return: array of RR Interval lengths
+    :return: array of RR Interval lengths, and the time of the R-peak ending
+             each interval, in seconds
     """
 
-    distances = [None] * (len(r_peaks) - 1)
-    r_peak_times = []
-    for i in range(1, len(r_peaks)):
-        distances[i - 1] = r_peaks[i] - r_peaks[i - 1]
-        temp = r_peaks[i] / (fs)
-        r_peak_times.append(temp)
-    return distances, r_peak_times
+    r_peaks = np.asarray(r_peaks)
+    return np.diff(r_peaks), r_peaks[1:] / fs
 
 
 def get_indexes(r_peak_times, window):
     """ computes zero-based indexes of windows for RR-Interval averages
 
+    a window closes at the first R-peak at or after each multiple of the
+    window width, but at most one window closes per R-peak, so a long gap
+    between beats delays the following boundaries instead of skipping them
+
     :param r_peak_times: data point locations of R-peaks, in seconds
     :param window: desired window width, in seconds
     :return: array of indexes
     """
 
-    indexes = []
-    multiplier = 1
-    for i in range(0, len(r_peak_times)):
-        if r_peak_times[i] >= multiplier*window:
-            indexes.append(i)
-            multiplier += 1
-    return indexes
+    times = np.asarray(r_peak_times, dtype=np.float64)
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.intp)
+    # crossed[i] is the largest multiplier with times[i] >= multiplier*window
+    crossed = np.floor(times / window).astype(np.int64)
+    crossed += (crossed + 1) * window <= times
+    crossed -= crossed * window > times
+    # closed[i] = min(closed[i - 1] + 1, crossed[i]) with closed[-1] = 0
+    i = np.arange(len(times))
+    closed = i + np.minimum(1, np.minimum.accumulate(crossed - i))
+    return np.flatnonzero(np.diff(np.concatenate(([0], closed))) > 0)
 
 
 def get_averages(distances, indexes):
     """ calculates RR Interval averages for a specific window of time
 
+    every window but the last has its outliers removed as in remove_outliers,
+    all windows at once: the intervals are sorted within their windows so
+    the quartiles can be picked out by position
+
     :param distances: array of RR-Interval widths
     :param indexes: zero-based indexes defining the windows of data
     :return: array of RR Interval averages
     """
 
-    averages = []
-    averages.append(np.mean(remove_outliers(distances[0:indexes[0]])))
-    for i in range(1, len(indexes)):
-        removed_outliers = remove_outliers(distances[indexes[i - 1]:indexes[i]])
-        average = np.mean(removed_outliers)
-        averages.append(average)
-    averages.append(np.mean(distances[indexes[len(indexes) - 1]:]))
+    distances = np.asarray(distances)
+    indexes = np.asarray(indexes)
+    closed = distances[:indexes[-1]]
+    starts = np.concatenate(([0], indexes[:-1]))
+    lengths = indexes - starts
+    windows = np.repeat(np.arange(len(indexes)), lengths)
+
+    sorted = closed[np.lexsort((closed, windows))]
+    first_quartile = sorted[starts + lengths // 4]
+    third_quartile = sorted[starts + 3 * lengths // 4]
+    iqr = third_quartile - first_quartile
+    keep = (closed >= (first_quartile - 1.5 * iqr)[windows]) & \
+        (closed <= (third_quartile + 1.5 * iqr)[windows])
+
+    sums = np.bincount(windows[keep], weights=closed[keep],
+                       minlength=len(indexes))
+    counts = np.bincount(windows[keep], minlength=len(indexes))
+    return np.append(sums / counts, np.mean(distances[indexes[-1]:]))
+
+
+class RollingBaseline(object):
+    """ median of a sliding window of RR intervals
+
+    the smaller half of the window is kept in a max-heap and the larger half
+    in a min-heap, so the median is at their tops and adding an interval is
+    O(log N). Removed intervals are only counted, and dropped once they
+    reach the top of their heap, which keeps removal O(log N) too.
+
+    """
+
+    def __init__(self):
+        self.low = []  # negated, so that the largest is at the top
+        self.high = []
+        self.removed = {}
+        self.low_size = 0
+        self.high_size = 0
+
+    def __len__(self):
+        return self.low_size + self.high_size
+
+    def add(self, distance):
+        if self.low_size == 0 or distance <= -self.low[0]:
+            hq.heappush(self.low, -distance)
+            self.low_size += 1
+        else:
+            hq.heappush(self.high, distance)
+            self.high_size += 1
+        self.rebalance()
+
+    def remove(self, distance):
+        self.removed[distance] = self.removed.get(distance, 0) + 1
+        if distance <= -self.low[0]:
+            self.low_size -= 1
+            if distance == -self.low[0]:
+                self.prune(self.low, -1)
+        else:
+            self.high_size -= 1
+            if distance == self.high[0]:
+                self.prune(self.high, 1)
+        self.rebalance()
+
+    def prune(self, heap, sign):
+        """ pops removed intervals off the top of a heap
+
+        :param heap: self.low or self.high
+        :param sign: -1 if the heap holds negated intervals, else 1
+        """
+
+        while heap and self.removed.get(sign * heap[0], 0) > 0:
+            self.removed[sign * heap[0]] -= 1
+            hq.heappop(heap)
+
+    def rebalance(self):
+        # the low half holds the extra interval of an odd-sized window
+        if self.low_size > self.high_size + 1:
+            hq.heappush(self.high, -hq.heappop(self.low))
+            self.low_size -= 1
+            self.high_size += 1
+            self.prune(self.low, -1)
+        elif self.low_size < self.high_size:
+            hq.heappush(self.low, -hq.heappop(self.high))
+            self.high_size -= 1
+            self.low_size += 1
+            self.prune(self.high, 1)
+
+    def median(self):
+        if (self.low_size + self.high_size) % 2:
+            return float(-self.low[0])
+        return (-self.low[0] + self.high[0]) / 2.0
+
+
+def get_rolling_averages(distances, beats):
+    """ calculates a rolling median RR Interval centered on each interval
+
+    interval i is compared with the intervals i - beats // 2 through
+    i + beats // 2, clipped to the ends of the recording
+
+    :param distances: array of RR-Interval widths
+    :param beats: number of RR Intervals in the rolling window
+    :return: array holding the baseline of each RR Interval
+    """
+
+    distances = np.asarray(distances).tolist()
+    half = beats // 2
+    baseline = RollingBaseline()
+    for distance in distances[:half]:
+        baseline.add(distance)
+    averages = np.empty(len(distances))
+    for i in range(len(distances)):
+        if i + half < len(distances):
+            baseline.add(distances[i + half])
+        if i - half - 1 >= 0:
+            baseline.remove(distances[i - half - 1])
+        averages[i] = baseline.median()
     return averages
 
 
+def get_baselines(distances, r_peak_times, window, baseline_beats=0):
+    """ calculates the RR Interval each interval is compared with
+
+    :param distances: array of RR-Interval widths
+    :param r_peak_times: data point locations of R-peaks, in seconds
+    :param window: interval for average processing (seconds)
+    :param baseline_beats: if nonzero, beats in the rolling RR baseline
+    :return: window indexes and window averages, or None and the rolling
+             baseline of every interval
+    """
+
+    if baseline_beats:
+        return None, get_rolling_averages(distances, baseline_beats)
+    indexes = get_indexes(r_peak_times, window)
+    return indexes, get_averages(distances, indexes)
+
+
 def get_mode(signal):
     """ calculates the mode of the amplitude of the original ECG signal
 
@@ -106,19 +245,15 @@ def remove_outliers(distances):
     :return: array of RR-Interval widths with outliers removed
     """
 
+    distances = np.asarray(distances)
     sorted = np.sort(distances)
     length = len(sorted)
-    first = int((length) / 4)
-    third = int(3 * (length) / 4)
-    first_quartile = sorted[first]
-    third_quartile = sorted[third]
+    first_quartile = sorted[int(length / 4)]
+    third_quartile = sorted[int(3 * length / 4)]
     iqr = third_quartile - first_quartile
-    dist = []
-
-    for i in range(0, len(distances)):
-        if distances[i] >= (first_quartile - 1.5 * iqr) and distances[i] <= (third_quartile + 1.5 * iqr):
-            dist.append(distances[i])
-    return dist
+    keep = (distances >= first_quartile - 1.5 * iqr) & \
+        (distances <= third_quartile + 1.5 * iqr)
+    return distances[keep]
 
 
 def get_y_vals(signal, pvc_indexes):
@@ -129,116 +264,195 @@ def get_y_vals(signal, pvc_indexes):
     :return: array of y-coordinates
     """
 
-    pvc_y_vals=[]
-    for i in range(0, len(pvc_indexes)):
-        pvc_y_vals.append(signal[pvc_indexes[i]])
-    return pvc_y_vals
-
-
-def process_pvc(signal, distances, averages, indexes, r_peaks, prematurity, compensatory, dist):
-    count = 0
-    pvc_count = 0
-    mode = get_mode(signal)
-    pvc_indexes_25 = []
-    pvc_indexes_50 = []
-    pvc_indexes_75 = []
-    pvc_indexes_100 = []
-
-    for i in range(0, len(distances) - 2):
-        if i > 0 and count < len(indexes) and i > indexes[count]:
-            count += 1
-        percent_error_one = (distances[i] - averages[count]) / averages[count]
-        if percent_error_one <= -prematurity:
-            pvc_indexes_25.append(r_peaks[i + 1])
-            percent_error_two = (distances[i + 1] - averages[count]) / averages[count]
-            if percent_error_two >= compensatory:
-                pvc_indexes_25.pop((len(pvc_indexes_25) - 1))
-                pvc_indexes_50.append(r_peaks[i + 1])
-                test_dist = (distances[i + 1] + distances[i]) / 2
-                test_dist_percent_error = (test_dist - averages[count]) / averages[count]
-                if abs(test_dist_percent_error) <= dist:
-                    pvc_indexes_50.pop((len(pvc_indexes_50) - 1))
-                    #print("****PVC75****", distances[i], r_peaks[i + 1], r_peak_times[i + 1], test_dist_percent_error,
-                          #test_dist, averages[count])
-
-                    pvc_indexes_75.append(r_peaks[i + 1])
-                    if signal[r_peaks[i + 1]] < mode:
-                        pvc_indexes_75.pop((len(pvc_indexes_75) - 1))
-                        pvc_indexes_100.append(r_peaks[i + 1])
-                        pvc_count += 1
-    return pvc_indexes_25, pvc_indexes_50, pvc_indexes_75, pvc_indexes_100, pvc_count
-
-
-def process_data(fs, window, signal):
-    """ main function for detecting PVCs
+    return np.asarray(signal)[np.asarray(pvc_indexes, dtype=np.intp)]
 
-     :param fs: sampling frequency of data
-     :param window: interval for average processing (seconds)
-     """
 
-    #data = get_signal_data(fs, window, ecg)
-    #signal = data[:, 1]
-    #signal = ecg
-    #print(signal)
+def process_pvc(signal, distances, averages, indexes, r_peaks, prematurity, compensatory, dist, mode=None, peak_values=None):
+    """ checks every RR interval against the PVC criteria of its window
+
+    :param signal: the filtered ECG signal, or None if mode and peak_values
+                   are given
+    :param distances: array of RR-Interval widths
+    :param averages: RR Interval average of each window
+    :param indexes: zero-based indexes defining the windows of data, or None
+                    if averages holds a baseline for every RR Interval
+    :param r_peaks: data point locations of R-peaks
+    :param prematurity: fraction by which a premature interval is short
+    :param compensatory: fraction by which the following interval is long
+    :param dist: largest fraction by which the two intervals may differ from
+                 the average on the whole
+    :param mode: mode of the signal, computed if not given
+    :param peak_values: filtered signal at each R-peak, read from signal if
+                        not given
+    :return: R-peaks meeting 1, 2, 3 and 4 criteria, and the number of PVCs
+    """
+
+    if mode is None:
+        mode = get_mode(signal)
+    distances = np.asarray(distances)
+    r_peaks = np.asarray(r_peaks)
+    n = max(len(distances) - 2, 0)
+
+    averages = np.asarray(averages, dtype=np.float64)
+    if indexes is None:
+        average = averages[:n]
+    else:
+        # interval i belongs to the window after every boundary below it
+        average = averages[np.searchsorted(indexes, np.arange(n), side="left")]
+    current = distances[:n]
+    following = distances[1:n + 1]
+    peaks = r_peaks[1:n + 1]
+
+    premature = (current - average) / average <= -prematurity
+    paused = (following - average) / average >= compensatory
+    balanced = abs(((following + current) / 2 - average) / average) <= dist
+    if peak_values is None:
+        inverted = get_y_vals(signal, peaks) < mode
+    else:
+        inverted = np.asarray(peak_values)[1:n + 1] < mode
+
+    met_two = premature & paused
+    met_three = met_two & balanced
+    pvc_indexes_25 = peaks[premature & ~paused]
+    pvc_indexes_50 = peaks[met_two & ~balanced]
+    pvc_indexes_75 = peaks[met_three & ~inverted]
+    pvc_indexes_100 = peaks[met_three & inverted]
+    return pvc_indexes_25, pvc_indexes_50, pvc_indexes_75, pvc_indexes_100, len(pvc_indexes_100)
+
+
+def detect_pvcs(fs, window, signal, baseline_beats=0, detector="biosppy"):
+    """ detects PVCs without plotting anything
+
+    :param fs: sampling frequency of data
+    :param window: interval for average processing (seconds)
+    :param signal: ecg data array
+    :param baseline_beats: if nonzero, each RR Interval is compared with the
+                           rolling median of this many intervals around it
+                           instead of the average of its window
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :return: Detection holding the R-peaks, RR intervals, window averages
+             and the PVC locations of each certainty tier
+    """
+
+    with im.stage("lowpass", samples=len(signal)):
+        lpf_signal = ff.butter_lowpass_filter(data=signal, cutoff=hmc.CUTOFF, fs=fs, order=5)
+    with im.stage("r_peaks", samples=len(signal), detector=detector) as record:
+        r_peaks, filtered = qrs_detect.get_detector(detector)(lpf_signal, fs)
+        record["beats"] = len(r_peaks)
+    with im.stage("baselines", beats=len(r_peaks)):
+        distances, r_peak_times = get_distances(r_peaks, fs)
+        indexes, averages = get_baselines(distances, r_peak_times, window,
+                                          baseline_beats)
+    with im.stage("mode", samples=len(filtered)):
+        mode = get_mode(filtered)
+
+    with im.stage("classify", beats=len(r_peaks)) as record:
+        pvc_indexes = process_pvc(filtered, distances, averages, indexes,
+                                  r_peaks, hmc.PREMATURITY, hmc.COMPENSATORY,
+                                  hmc.DISTANCE, mode=mode)
+        record["tiers"] = [len(tier) for tier in pvc_indexes[:4]]
+    return Detection(lpf_signal, filtered, r_peaks, distances, r_peak_times,
+                     indexes, averages, mode, pvc_indexes[:4])
+
+
+def pvc_locations(detection):
+    """ flattens the tiers of a detection into (index, certainty) tuples
+
+    :param detection: Detection returned by detect_pvcs
+    :return: list of (index, certainty) tuples sorted by index
+    """
 
-    lpf_signal = ff.butter_lowpass_filter(data=signal, cutoff=hmc.CUTOFF, fs=hmc.SAMPLE_RATE, order=5)
+    indexes = np.concatenate([np.asarray(tier, dtype=np.int64)
+                              for tier in detection.tiers])
+    certainties = np.repeat(np.arange(1, len(detection.tiers) + 1),
+                            [len(tier) for tier in detection.tiers])
+    order = np.argsort(indexes, kind="stable")
+    return generate_array(indexes[order], certainties[order])
+
+
+def downsample(signal, max_points=hmc.MAX_PLOT_POINTS):
+    """ reduces a signal to the minimum and maximum of evenly sized buckets
+
+    :param signal: ecg data array
+    :param max_points: largest number of points to return
+    :return: (x, y) arrays of sample indexes and values
+    """
+
+    signal = np.asarray(signal)
+    bucket = int(np.ceil(2.0 * len(signal) / max_points))
+    if bucket <= 1:
+        return np.arange(len(signal)), signal
+    starts = np.arange(0, len(signal), bucket)
+    x = np.repeat(starts + bucket // 2, 2)
+    x[-2:] = min(x[-1], len(signal) - 1)
+    lows, highs = ff.minmax_buckets(signal, bucket)
+    y = np.empty(len(x), dtype=signal.dtype)
+    y[0::2] = signal[lows]
+    y[1::2] = signal[highs]
+    return x, y
+
+
+def plot_detection(signal, detection, max_points=hmc.MAX_PLOT_POINTS):
+    """ plots the raw and filtered signals with the detected PVCs
+
+    :param signal: the original ECG signal
+    :param detection: Detection returned by detect_pvcs
+    :param max_points: largest number of points drawn per trace
+    """
+
+    import matplotlib.pyplot as plt
 
     plt.subplot(2, 1, 1)
-    plt.plot(signal, '-b')
+    plt.plot(*downsample(signal, max_points) + ('-b',))
     plt.title('Unfiltered Data')
 
     plt.subplot(2, 1, 2)
-    plt.plot(lpf_signal, '-g')
+    plt.plot(*downsample(detection.lpf_signal, max_points) + ('-g',))
     plt.title('Filtered Data')
     plt.show()
 
-    out = ecg.ecg(signal=lpf_signal, sampling_rate=fs, show=False)
-    r_peaks = out['rpeaks']
-    filtered = out['filtered']
-    distance_data = get_distances(r_peaks, fs)
-    distances = distance_data[0]
-    r_peak_times = distance_data[1]
-    indexes = get_indexes(r_peak_times, window)
-    averages = get_averages(distances, indexes)
-
-    pvc_indexes = process_pvc(filtered, distances, averages, indexes, r_peaks, .12, .05, .2)
-    pvc_indexes_25=pvc_indexes[0]
-    pvc_indexes_50=pvc_indexes[1]
-    pvc_indexes_75=pvc_indexes[2]
-    pvc_indexes_100=pvc_indexes[3]
-    pvc_count = pvc_indexes[4]
-
-    pvc_y_vals_25 = get_y_vals(filtered, pvc_indexes_25)
-    pvc_y_vals_50 = get_y_vals(filtered, pvc_indexes_50)
-    pvc_y_vals_75 = get_y_vals(filtered, pvc_indexes_75)
-    pvc_y_vals_100 = get_y_vals(filtered, pvc_indexes_100)
-
-    print(pvc_count, "PVCs detected.")
-    #plt.plot(filtered, '-')
-    plt.plot(filtered, '-', pvc_indexes_25, pvc_y_vals_25, 'r.',  pvc_indexes_50, pvc_y_vals_50, 'c.',pvc_indexes_75, pvc_y_vals_75, 'm.', pvc_indexes_100, pvc_y_vals_100, 'g.', markersize=20)
+    pvc_count = len(detection.tiers[3])
+    args = list(downsample(detection.filtered, max_points) + ('-',))
+    for tier, style in zip(detection.tiers, ['r.', 'c.', 'm.', 'g.']):
+        args += [tier, get_y_vals(detection.filtered, tier), style]
+    plt.plot(*args, markersize=20)
     plt.legend(['ECG Signal', '1 PVC Criterion Met', '2 PVC Criteria Met', '3 PVC Criteria Met', 'PVC'])
     plt.title(str(pvc_count) + " PVCs detected")
+    plt.show()
 
-    arr_25 = generate_array(pvc_indexes_25, 1)
-    arr_50 = generate_array(pvc_indexes_50, 2)
-    arr_75 = generate_array(pvc_indexes_75, 3)
-    arr_100 = generate_array(pvc_indexes_100, 4)
-
-    locs = arr_25+arr_50+arr_75+arr_100
 
-    locs = sorted(locs, key=lambda tup: tup[0])
+def process_data(fs, window, signal, plot=False, baseline_beats=0,
+                 detector="biosppy", beats=None):
+    """ main function for detecting PVCs
 
-    #print(locs)
-    plt.show()
+     :param fs: sampling frequency of data
+     :param window: interval for average processing (seconds)
+     :param signal: ecg data array
+     :param plot: if True, shows diagnostic plots of the detection
+     :param baseline_beats: if nonzero, beats in the rolling RR baseline
+     :param detector: name of the R-peak detector in qrs_detect.detectors
+     :param beats: if given, a list the R-peak locations are appended to
+     :return: list of (index, certainty) tuples sorted by index
+     """
 
-    return locs
+    detection = detect_pvcs(fs, window, signal, baseline_beats, detector)
+    log.info("{0} PVCs detected.".format(len(detection.tiers[3])))
+    if beats is not None:
+        beats.extend(np.asarray(detection.r_peaks).tolist())
+    if plot:
+        plot_detection(signal, detection)
+    return pvc_locations(detection)
 
 def generate_array(indexes, val):
-    arr=[]
-    for index in indexes:
-        tuple = (index, val)
-        arr.append(tuple)
-    return arr
+    """ pairs PVC locations with their certainty
+
+    :param indexes: data point locations of PVCs
+    :param val: certainty of every PVC, or an array of one per PVC
+    :return: list of (index, certainty) tuples
+    """
+
+    vals = np.broadcast_to(val, (len(indexes),))
+    return list(zip(np.asarray(indexes).tolist(), vals.tolist()))
 
 
 def read_lvm(filename, folder):
@@ -246,23 +460,11 @@ def read_lvm(filename, folder):
 
     :param filename: name of lvm file
     :param folder: folder where data files are kept
-    :return: ecg data array
+    :return: dictionary holding the (time, ecg) data array
     """
 
-    extension = os.path.splitext(filename)[1]
-    if extension != ".lvm":
-        message = filename + " was not a LabView file"
-        #log.error(message)
-        raise hme.InvalidFormatError(message)
-    data = lr.read(file_path(folder, filename))
-
-    if data["Segments"] != 1:
-        message = "multiple segments detected in " + filename
-        #log.error(message)
-        raise hme.InvalidFormatError(message)
-
-    #log.debug("successfully read and constructed ecg data from " + filename)
-    return data[0]
+    time, ecg = ir.read_lvm(filename, folder)
+    return {"data": np.column_stack((time, ecg))}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,230 @@
+import os
+import shutil
+import tempfile
+import logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import holter_monitor_constants as hmc
+import filter_functions as ff
+import pvc_detect_two as pvc_detect
+import pvc_stream
+import qrs_detect
+
+log = logging.getLogger("hm_logger")
+
+
+def pool_context():
+    """ picks how worker processes are started
+
+    holter_monitor.py is a script, so workers are forked rather than spawned
+    wherever possible to keep them from re-running it
+
+    :return: multiprocessing context, or None for the default
+    """
+
+    if "fork" in mp.get_all_start_methods():
+        return mp.get_context("fork")
+    return None
+
+
+def share_signal(signal, folder):
+    """ copies ecg data into a .npy file that workers memory-map
+
+    :param signal: ecg data array
+    :param folder: folder to write the file in
+    :return: path of the .npy file
+    """
+
+    path = os.path.join(folder, "signal.npy")
+    shared = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                       shape=(len(signal),))
+    for start in range(0, len(signal), hmc.READ_CHUNK_SIZE):
+        end = start + hmc.READ_CHUNK_SIZE
+        shared[start:end] = signal[start:end]
+    shared.flush()
+    del shared
+    return path
+
+
+def detect_segment(path, fs, start, end, overlap, detector="biosppy"):
+    """ finds the R-peaks of one segment of a memory-mapped recording
+
+    the segment is filtered together with overlap samples on either side, so
+    the filters have settled by the time they reach the segment itself.
+    R-peaks up to a refractory period past either end are kept too, so that
+    stitch can match them with those of the neighbouring segment
+
+    :param path: .npy file holding the ecg data
+    :param fs: sampling frequency of data
+    :param start: first sample of the segment
+    :param end: sample after the last sample of the segment
+    :param overlap: samples read past each end of the segment
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :return: R-peaks in and around the segment, the filtered signal at each
+             of them, and a RunningMode of the filtered segment
+    """
+
+    signal = np.load(path, mmap_mode="r")
+    first = max(start - overlap, 0)
+    last = min(end + overlap, len(signal))
+    lpf_signal = ff.butter_lowpass_filter(data=signal[first:last],
+                                         cutoff=hmc.CUTOFF, fs=fs, order=5)
+    r_peaks, filtered = qrs_detect.get_detector(detector)(lpf_signal, fs)
+
+    margin = int(hmc.REFRACTORY * fs)
+    r_peaks = r_peaks[(r_peaks >= start - first - margin) &
+                      (r_peaks < end - first + margin)]
+    running_mode = pvc_stream.RunningMode()
+    running_mode.update(filtered[start - first:end - first])
+    return r_peaks + first, filtered[r_peaks], running_mode
+
+
+def match_seam(before, after, seam, margin):
+    """ pairs up the R-peaks two adjacent segments found for the same beats
+
+    :param before: R-peaks of the segment ending at seam
+    :param after: R-peaks of the segment starting at seam
+    :param seam: first sample of the later segment
+    :param margin: largest distance between two R-peaks of one beat
+    :return: list of (index in before, index in after) pairs
+    """
+
+    i = np.searchsorted(before, seam - margin)
+    j = 0
+    pairs = []
+    while i < len(before) and j < len(after) and after[j] < seam + margin:
+        # an R-peak is only paired with the nearest one of the other segment
+        gap = abs(int(before[i]) - int(after[j]))
+        if i + 1 < len(before) and abs(int(before[i + 1]) - int(after[j])) < gap:
+            i += 1
+        elif j + 1 < len(after) and abs(int(before[i]) - int(after[j + 1])) < gap:
+            j += 1
+        elif gap < margin:
+            pairs.append((i, j))
+            i += 1
+            j += 1
+        elif before[i] < after[j]:
+            i += 1
+        else:
+            j += 1
+    return pairs
+
+
+def stitch(results, bounds, fs):
+    """ joins the R-peaks of consecutive segments
+
+    each segment owns the R-peaks inside its own bounds. A beat near a seam
+    can be found by both segments a few samples apart, possibly each on the
+    other side of the seam, so the R-peaks both segments found within a
+    refractory period of each other are taken as one beat. It is kept where
+    the segment owning that location put it, or where the earlier segment
+    put it if both or neither do. A beat only one segment found outside its
+    own bounds is left to the segment owning it.
+
+    :param results: detect_segment results, in segment order
+    :param bounds: (start, end) of each segment
+    :param fs: sampling frequency of data
+    :return: R-peaks, the filtered signal at each of them, and the mode of
+             the whole filtered signal
+    """
+
+    margin = int(hmc.REFRACTORY * fs)
+    keep = [(segment_peaks >= start) & (segment_peaks < end)
+            for (segment_peaks, _, _), (start, end) in zip(results, bounds)]
+    for k in range(1, len(results)):
+        before = results[k - 1][0]
+        after = results[k][0]
+        seam = bounds[k][0]
+        for i, j in match_seam(before, after, seam, margin):
+            later = before[i] >= seam and after[j] >= seam
+            keep[k - 1][i] = not later
+            keep[k][j] = later
+
+    running_mode = pvc_stream.RunningMode()
+    for segment_result in results:
+        running_mode.merge(segment_result[2])
+    r_peaks = np.concatenate([segment_peaks[segment_keep]
+                              for (segment_peaks, _, _), segment_keep
+                              in zip(results, keep)])
+    peak_values = np.concatenate([segment_values[segment_keep]
+                                  for (_, segment_values, _), segment_keep
+                                  in zip(results, keep)])
+    order = np.argsort(r_peaks, kind="stable")
+    return r_peaks[order], peak_values[order], running_mode.mode()
+
+
+def segment_bounds(length, step, shortest):
+    """ splits a recording into the segments analyzed by workers
+
+    :param length: number of samples in the recording
+    :param step: samples in each segment
+    :param shortest: fewest samples in a segment; a shorter step is
+                     lengthened, and a shorter last segment is joined to the
+                     one before it
+    :return: list of (start, end) of each segment
+    """
+
+    step = max(step, shortest, 1)
+    starts = list(range(0, length, step))
+    if len(starts) > 1 and length - starts[-1] < shortest:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [length]))
+
+
+def process_parallel(fs, window, signal, workers=None,
+                     segment=hmc.PARALLEL_SEGMENT,
+                     overlap=hmc.PARALLEL_OVERLAP,
+                     baseline_beats=0,
+                     detector="biosppy",
+                     beats=None):
+    """ detects PVCs with R-peak detection spread over worker processes
+
+    workers filter overlapping segments of the recording and find their
+    R-peaks; the RR baselines, the mode and the classification span the
+    whole recording, so they are computed here once the peaks are stitched
+
+    :param fs: sampling frequency of data
+    :param window: interval for average processing (seconds)
+    :param signal: ecg data array
+    :param workers: number of worker processes, one per CPU if None
+    :param segment: seconds of ecg analyzed by each worker task, at least
+                    hmc.PARALLEL_MIN_SEGMENT
+    :param overlap: seconds each segment reads past both of its ends
+    :param baseline_beats: if nonzero, beats in the rolling RR baseline
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :param beats: if given, a list the R-peak locations are appended to
+    :return: list of (index, certainty) tuples sorted by index
+    """
+
+    bounds = segment_bounds(len(signal), int(segment * fs),
+                            int(hmc.PARALLEL_MIN_SEGMENT * fs))
+    overlap = int(overlap * fs)
+    folder = tempfile.mkdtemp(prefix="holter_monitor_")
+    try:
+        path = share_signal(signal, folder)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=pool_context()) as executor:
+            futures = [executor.submit(detect_segment, path, fs, start, end,
+                                       overlap, detector)
+                       for start, end in bounds]
+            results = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(folder)
+
+    r_peaks, peak_values, mode = stitch(results, bounds, fs)
+    if beats is not None:
+        beats.extend(r_peaks.tolist())
+    distances, r_peak_times = pvc_detect.get_distances(r_peaks, fs)
+    indexes, averages = pvc_detect.get_baselines(distances, r_peak_times,
+                                                 window, baseline_beats)
+    pvc_indexes = pvc_detect.process_pvc(None, distances, averages, indexes,
+                                         r_peaks, hmc.PREMATURITY,
+                                         hmc.COMPENSATORY, hmc.DISTANCE,
+                                         mode=mode, peak_values=peak_values)
+    detection = pvc_detect.Detection(None, None, r_peaks, distances,
+                                     r_peak_times, indexes, averages, mode,
+                                     pvc_indexes[:4])
+    log.info("{0} PVCs detected in {1} segments.".format(
+        len(detection.tiers[3]), len(results)))
+    return pvc_detect.pvc_locations(detection)
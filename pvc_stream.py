@@ -0,0 +1,371 @@
+import holter_monitor_constants as hmc
+import numpy as np
+import filter_functions as ff
+import pvc_detect_two as pvc_detect
+import qrs_detect
+
+
+def fold(counts, first_bin):
+    """ adds up each pair of neighbouring histogram bins
+
+    :param counts: counts of consecutive bins
+    :param first_bin: index of the first bin
+    :return: counts of bins twice as wide, index of the first of them
+    """
+
+    if first_bin % 2:
+        counts = np.concatenate(([0], counts))
+    if len(counts) % 2:
+        counts = np.concatenate((counts, [0]))
+    return counts.reshape(-1, 2).sum(axis=1), first_bin // 2
+
+
+class RunningMode(object):
+    """ running estimate of get_mode over every sample seen so far
+
+    samples are counted in at most hmc.MODE_BINS fine bins, which are
+    regrouped into the same ten histogram bins get_mode uses whenever the
+    mode is requested. Whenever the samples span more bins than that, pairs
+    of neighbouring bins are merged, so memory stays fixed whatever the
+    units of the signal.
+
+    """
+
+    def __init__(self, resolution=hmc.MODE_RESOLUTION, bins=hmc.MODE_BINS):
+        self.resolution = resolution
+        self.bins = bins
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.first_bin = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def update(self, samples):
+        if len(samples) == 0:
+            return
+        samples = np.asarray(samples)
+        self.minimum = min(self.minimum, float(np.min(samples)))
+        self.maximum = max(self.maximum, float(np.max(samples)))
+        while True:
+            low = int(np.floor(self.minimum / self.resolution))
+            high = int(np.floor(self.maximum / self.resolution))
+            if high - low < self.bins:
+                break
+            self.coarsen()
+        bins = np.floor(samples / self.resolution).astype(np.int64)
+        self.extend(bins.min(), bins.max())
+        self.counts += np.bincount(bins - self.first_bin,
+                                   minlength=len(self.counts))
+
+    def coarsen(self):
+        """ merges each pair of neighbouring bins, doubling the resolution
+        """
+
+        self.counts, self.first_bin = fold(self.counts, self.first_bin)
+        self.resolution *= 2
+
+    def extend(self, low, high):
+        """ grows the histogram to cover bins low through high
+        """
+
+        if len(self.counts) == 0:
+            self.first_bin = low
+        if low < self.first_bin or high >= self.first_bin + len(self.counts):
+            new_first = min(low, self.first_bin)
+            new_last = max(high + 1, self.first_bin + len(self.counts))
+            counts = np.zeros(new_last - new_first, dtype=np.int64)
+            start = self.first_bin - new_first
+            counts[start:start + len(self.counts)] = self.counts
+            self.counts = counts
+            self.first_bin = new_first
+
+    def merge(self, other):
+        """ adds the samples counted by another RunningMode
+
+        :param other: RunningMode started with the same resolution
+        """
+
+        if len(other.counts) == 0:
+            return
+        counts, first_bin, resolution = \
+            other.counts, other.first_bin, other.resolution
+        while True:
+            while self.resolution < resolution:
+                self.coarsen()
+            while resolution < self.resolution:
+                counts, first_bin = fold(counts, first_bin)
+                resolution *= 2
+            low, high = first_bin, first_bin + len(counts) - 1
+            if len(self.counts) > 0:
+                low = min(low, self.first_bin)
+                high = max(high, self.first_bin + len(self.counts) - 1)
+            if high - low < self.bins:
+                break
+            self.coarsen()
+        self.extend(first_bin, first_bin + len(counts) - 1)
+        start = first_bin - self.first_bin
+        self.counts[start:start + len(counts)] += counts
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def mode(self):
+        edges = np.linspace(self.minimum, self.maximum, 11)
+        centers = (np.arange(len(self.counts)) + self.first_bin + 0.5) * \
+            self.resolution
+        coarse = np.clip(np.searchsorted(edges, centers, side="right") - 1,
+                         0, 9)
+        freqs = np.bincount(coarse, weights=self.counts, minlength=10)
+        index = np.argmax(freqs)
+        return (edges[index] + edges[index + 1]) / 2
+
+
+class StreamingPVCDetector(object):
+    """ incremental version of pvc_detect_two.process_data
+
+    chunks of raw ecg are low-pass filtered with carried filter state, and
+    R-peaks are found by running biosppy on overlapping segments of the
+    filtered signal. RR intervals are assigned to the same tumbling windows
+    as get_indexes, and each beat is classified as soon as its compensatory
+    beat has arrived and its window average is known. Only the current
+    segment and the beats of the open windows are kept in memory.
+
+    With baseline_beats set, each interval is instead compared with the
+    rolling median of the intervals around it, as in get_rolling_averages,
+    and is classified once the intervals after it have arrived.
+
+    """
+
+    def __init__(self, fs=hmc.SAMPLE_RATE, window=10,
+                 prematurity=hmc.PREMATURITY,
+                 compensatory=hmc.COMPENSATORY,
+                 dist=hmc.DISTANCE,
+                 segment=hmc.STREAM_SEGMENT,
+                 context=hmc.STREAM_CONTEXT,
+                 lookahead=hmc.STREAM_LOOKAHEAD,
+                 baseline_beats=0,
+                 detector="biosppy",
+                 beats=None):
+        self.fs = fs
+        self.window = window
+        self.prematurity = prematurity
+        self.compensatory = compensatory
+        self.dist = dist
+        self.segment = int(segment * fs)
+        self.context = int(context * fs)
+        self.lookahead = int(lookahead * fs)
+        self.detect = qrs_detect.get_detector(detector)
+        self.beats = beats
+
+        self.lowpass = ff.lowpass(hmc.CUTOFF, fs, order=5)
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0  # sample index of buffer[0]
+        self.accepted = 0  # R-peaks before this sample index are final
+        self.running_mode = RunningMode()
+        self.mode = None
+
+        # beats are kept from self.base onwards, indexed by RR interval
+        self.base = 0
+        self.r_peaks = []  # r_peaks[i] is the beat ending interval i - 1
+        self.peak_values = []
+        self.distances = []
+        self.indexes = []  # window boundaries, as in get_indexes
+        self.averages = []
+        self.multiplier = 1
+        self.next_interval = 0
+
+        # intervals [baseline_start, baseline_end) are in the rolling baseline
+        self.half = baseline_beats // 2 if baseline_beats else None
+        self.baseline = pvc_detect.RollingBaseline()
+        self.baseline_start = 0
+        self.baseline_end = 0
+
+    def process(self, chunk):
+        """ feeds a chunk of raw ecg samples to the detector
+
+        :param chunk: ecg data array
+        :return: list of (index, certainty) PVC events that became final
+        """
+
+        lpf = self.lowpass.process(chunk)
+        self.buffer = np.concatenate((self.buffer, lpf))
+        events = []
+        buffer_end = self.buffer_start + len(self.buffer)
+        while buffer_end - self.accepted >= self.segment + self.lookahead:
+            self.analyze(self.accepted + self.segment)
+            events += self.classify(final=False)
+        return events
+
+    def flush(self):
+        """ analyzes whatever is left at the end of the recording
+
+        :return: list of (index, certainty) PVC events
+        """
+
+        buffer_end = self.buffer_start + len(self.buffer)
+        if buffer_end > self.accepted:
+            self.analyze(buffer_end)
+        if self.half is None and len(self.averages) == len(self.indexes) and \
+                len(self.distances) > 0:
+            # the last window is averaged without removing outliers
+            start = self.indexes[-1] if len(self.indexes) > 0 else 0
+            self.averages.append(np.mean(self.distances[start - self.base:]))
+        return self.classify(final=True)
+
+    def analyze(self, accept_until):
+        """ finds the R-peaks in [self.accepted, accept_until) using the
+        buffered context on either side of that range
+
+        :param accept_until: sample index up to which R-peaks become final
+        """
+
+        start = max(self.accepted - self.context, self.buffer_start)
+        segment = self.buffer[start - self.buffer_start:]
+        r_peaks, filtered = self.detect(segment, self.fs)
+        for peak in r_peaks:
+            if self.accepted <= peak + start < accept_until:
+                self.add_peak(int(peak + start), filtered[peak])
+
+        self.running_mode.update(filtered[self.accepted - start:
+                                          accept_until - start])
+        self.mode = self.running_mode.mode()
+        self.accepted = accept_until
+        keep = max(self.accepted - self.context, self.buffer_start)
+        self.buffer = self.buffer[keep - self.buffer_start:]
+        self.buffer_start = keep
+
+    def add_peak(self, peak, value):
+        if self.beats is not None:
+            self.beats.append(peak)
+        self.r_peaks.append(peak)
+        self.peak_values.append(value)
+        if len(self.r_peaks) - 1 + self.base == 0:
+            return
+
+        interval = len(self.distances) + self.base
+        self.distances.append(peak - self.r_peaks[-2])
+        if self.half is None and \
+                peak / self.fs >= self.multiplier * self.window:
+            start = self.indexes[-1] if len(self.indexes) > 0 else 0
+            self.indexes.append(interval)
+            self.multiplier += 1
+            window = self.distances[start - self.base:interval - self.base]
+            # a window can close before any interval of its own has arrived;
+            # it has no average, as in get_averages
+            self.averages.append(
+                np.mean(pvc_detect.remove_outliers(window))
+                if len(window) > 0 else np.nan)
+
+    def classify(self, final):
+        """ classifies every beat whose window average and following
+        intervals are known
+
+        :param final: True once no more beats will arrive
+        :return: list of (index, certainty) PVC events
+        """
+
+        events = []
+        total = len(self.distances) + self.base
+        while self.next_interval + 2 < total:
+            i = self.next_interval
+            if self.half is None:
+                count = np.searchsorted(self.indexes, i)
+                if count >= len(self.averages):
+                    break
+                average = self.averages[count]
+            else:
+                average = self.rolling_average(i, total, final)
+                if average is None:
+                    break
+            d0 = self.distances[i - self.base]
+            d1 = self.distances[i + 1 - self.base]
+            certainty = 0
+            if (d0 - average) / average <= -self.prematurity:
+                certainty = 1
+                if (d1 - average) / average >= self.compensatory:
+                    certainty = 2
+                    if abs(((d1 + d0) / 2 - average) / average) <= self.dist:
+                        certainty = 3
+                        if self.peak_values[i + 1 - self.base] < self.mode:
+                            certainty = 4
+            if certainty > 0:
+                events.append((self.r_peaks[i + 1 - self.base], certainty))
+            self.next_interval += 1
+        if not final:
+            self.prune()
+        return events
+
+    def rolling_average(self, i, total, final):
+        """ moves the rolling baseline to be centered on interval i
+
+        :param i: index of the RR interval being classified
+        :param total: number of RR intervals seen so far
+        :param final: True once no more beats will arrive
+        :return: median of the intervals around i, or None if some of them
+                 have not arrived yet
+        """
+
+        end = i + self.half + 1
+        if end > total:
+            if not final:
+                return None
+            end = total
+        for j in range(self.baseline_end, end):
+            self.baseline.add(self.distances[j - self.base])
+        for j in range(self.baseline_start, i - self.half):
+            self.baseline.remove(self.distances[j - self.base])
+        self.baseline_end = end
+        self.baseline_start = max(self.baseline_start, i - self.half)
+        return self.baseline.median()
+
+    def prune(self):
+        """ drops beats that no open window or pending beat still needs
+        """
+
+        if self.half is not None:
+            drop = self.baseline_start - self.base
+            if drop > 0:
+                del self.r_peaks[:drop]
+                del self.peak_values[:drop]
+                del self.distances[:drop]
+                self.base += drop
+            return
+        start = self.indexes[-1] if len(self.indexes) > 0 else 0
+        drop = min(start, self.next_interval) - self.base
+        if drop > 0:
+            del self.r_peaks[:drop]
+            del self.peak_values[:drop]
+            del self.distances[:drop]
+            self.base += drop
+        # windows that closed before the next pending beat are no longer
+        # needed, except the last one, which starts the next window
+        closed = min(np.searchsorted(self.indexes, self.next_interval),
+                     len(self.indexes) - 1)
+        if closed > 0:
+            del self.indexes[:closed]
+            del self.averages[:closed]
+
+
+def process_stream(fs, window, chunks, baseline_beats=0, detector="biosppy",
+                   beats=None):
+    """ detects PVCs in a stream of ecg chunks with bounded memory
+
+    :param fs: sampling frequency of data
+    :param window: interval for average processing (seconds)
+    :param chunks: iterable of ecg data arrays, or of (time, ecg) tuples
+    :param baseline_beats: if nonzero, beats in the rolling RR baseline
+    :param detector: name of the R-peak detector in qrs_detect.detectors
+    :param beats: if given, a list R-peak locations are appended to as they
+                  become final
+    :return: generator of (index, certainty) PVC events, in index order
+    """
+
+    pvc_detector = StreamingPVCDetector(fs, window,
+                                        baseline_beats=baseline_beats,
+                                        detector=detector,
+                                        beats=beats)
+    for chunk in chunks:
+        if isinstance(chunk, tuple):
+            chunk = chunk[1]
+        for event in pvc_detector.process(chunk):
+            yield event
+    for event in pvc_detector.flush():
+        yield event
@@ -0,0 +1,141 @@
+import numpy as np
+from scipy.signal import find_peaks
+from numpy.lib.stride_tricks import sliding_window_view
+import holter_monitor_constants as hmc
+import holter_monitor_errors as hme
+import filter_functions as ff
+import logging
+
+log = logging.getLogger("hm_logger")
+
+
+def biosppy_detect(signal, fs):
+    """ finds R-peaks with biosppy's hamilton segmenter
+
+    :param signal: low-pass filtered ecg data array
+    :param fs: sampling frequency of data
+    :return: (R-peak locations, band-pass filtered signal)
+    """
+
+    # biosppy imports pyplot, so it is only loaded once detection runs
+    from biosppy.signals import ecg
+
+    out = ecg.ecg(signal=signal, sampling_rate=fs, show=False)
+    return out['rpeaks'], out['filtered']
+
+
+def pan_tompkins_detect(signal, fs):
+    """ finds R-peaks with a Pan-Tompkins QRS detector
+
+    the signal is band-passed to the QRS band, differentiated, squared and
+    integrated over a moving window; peaks of the integrated signal are
+    accepted against adaptive signal and noise levels, with a search back
+    at half threshold after a missed beat. Each accepted peak is then moved
+    to the largest deflection of the filtered signal near it, either way,
+    within a tolerance wide enough to reach the R-wave of a broad ectopic
+    beat.
+
+    :param signal: low-pass filtered ecg data array
+    :param fs: sampling frequency of data
+    :return: (R-peak locations, band-pass filtered signal)
+    """
+
+    signal = np.asarray(signal, dtype=np.float64)
+    settle = int(hmc.QRS_SETTLE * fs)
+    if len(signal) < settle + 2 * fs:
+        return np.zeros(0, dtype=int), signal - np.mean(signal)
+
+    # an offset such as raw ADC counts would make the filters ring at both
+    # ends of the recording
+    signal = signal - np.median(signal)
+    filtered = ff.bandpass(hmc.QRS_FILTER_BAND, fs).filtfilt(signal)
+    filtered -= np.mean(filtered)
+    qrs_band = ff.bandpass(hmc.QRS_ENERGY_BAND, fs).filtfilt(signal)
+
+    # five point derivative, squared, then a centered moving window integral
+    derivative = np.convolve(qrs_band, np.array([1, 2, 0, -2, -1]) * fs / 8.0,
+                             mode="same")
+    width = max(int(hmc.QRS_INTEGRATION * fs), 1)
+    energy = np.convolve(derivative ** 2, np.ones(width) / width, mode="same")
+
+    candidates, _ = find_peaks(energy, distance=max(int(hmc.REFRACTORY * fs),
+                                                    1))
+    # the low-pass filter applied before detection starts from rest, so the
+    # levels are learned from the two seconds after it has settled
+    beats = accept_peaks(candidates, energy[candidates],
+                         energy[settle:settle + int(2 * fs)], fs)
+
+    tolerance = int(hmc.QRS_TOLERANCE * fs)
+    beats = beats[(beats >= tolerance) & (beats < len(filtered) - tolerance)]
+    if len(beats) == 0:
+        return beats, filtered
+    # an ectopic beat is often inverted, so its R-peak is the largest
+    # deflection either way rather than the following positive lobe
+    windows = sliding_window_view(np.abs(filtered), 2 * tolerance)
+    r_peaks = beats - tolerance + np.argmax(windows[beats - tolerance], axis=1)
+    return np.unique(r_peaks), filtered
+
+
+def accept_peaks(candidates, heights, learning, fs):
+    """ sorts candidate peaks into QRS complexes and noise
+
+    :param candidates: locations of peaks of the integrated signal
+    :param heights: integrated signal at each candidate
+    :param learning: integrated signal used to initialize the levels
+    :param fs: sampling frequency of data
+    :return: array of accepted candidate locations
+    """
+
+    signal_level = 0.25 * np.max(learning)
+    noise_level = 0.5 * np.mean(learning)
+    accepted = []
+    rr_average = None
+    last = None
+    for i in range(len(candidates)):
+        threshold = noise_level + 0.25 * (signal_level - noise_level)
+        if rr_average is not None and \
+                candidates[i] - candidates[last] > 1.66 * rr_average:
+            # a beat was missed, so take the largest skipped candidate that
+            # clears half the threshold
+            skipped = np.arange(last + 1, i)
+            skipped = skipped[heights[skipped] > threshold / 2]
+            skipped = skipped[candidates[skipped] - candidates[last] >=
+                              hmc.REFRACTORY * fs]
+            if len(skipped) > 0:
+                found = skipped[np.argmax(heights[skipped])]
+                accepted.append(found)
+                signal_level = 0.25 * heights[found] + 0.75 * signal_level
+                last = found
+        if heights[i] > threshold:
+            if last is not None:
+                rr = candidates[i] - candidates[last]
+                rr_average = rr if rr_average is None else \
+                    0.125 * rr + 0.875 * rr_average
+            accepted.append(i)
+            # artifacts can be orders of magnitude above any QRS complex, so
+            # one is not allowed to raise the threshold past every later beat
+            height = min(heights[i], hmc.QRS_ARTIFACT * signal_level)
+            signal_level = 0.125 * height + 0.875 * signal_level
+            last = i
+        else:
+            noise_level = 0.125 * heights[i] + 0.875 * noise_level
+    return candidates[np.array(accepted, dtype=int)]
+
+
+detectors = {"biosppy": biosppy_detect,
+             "pan_tompkins": pan_tompkins_detect}
+
+
+def get_detector(name):
+    """ looks up an R-peak detector by name
+
+    :param name: key of the detector in detectors
+    :return: function taking (signal, fs) and returning (R-peaks, filtered)
+    """
+
+    if name not in detectors:
+        message = "Unknown R-peak detector {0}; choose from {1}".format(
+            name, sorted(detectors))
+        log.error(message)
+        raise hme.InputError(message)
+    return detectors[name]
@@ -0,0 +1,139 @@
+import os
+import time
+import threading
+import contextlib
+import numpy as np
+import pytest
+import database_manager as dm
+
+
+@pytest.fixture
+def manager(tmpdir):
+    manager = dm.DatabaseManager(os.path.join(str(tmpdir), "summary.db"))
+    yield manager
+    manager.close()
+
+
+def test_upload_stores_summary_and_burden(manager):
+    # 150 s at 100 Hz with a beat every second, starting at t0 = 5 s
+    sample_rate = 100
+    ecg = np.sin(np.arange(15000) / 10.0)
+    time = 5.0 + np.arange(len(ecg)) / float(sample_rate)
+    r_peaks = np.arange(50, 15000, 100)
+    pvcs = [(1050, 1), (2050, 4), (7050, 4), (7150, 2), (14050, 3)]
+    recording = manager.upload(time, ecg, pvcs, sample_rate=sample_rate,
+                               name="summary", r_peaks=r_peaks)
+
+    assert manager.query_summary(60, recording) == [
+        [5.0, 60, 1, 0, 0, 1, 60.0],
+        [65.0, 60, 0, 1, 0, 1, 60.0],
+        [125.0, 30, 0, 0, 1, 0, 60.0],
+    ]
+    assert manager.query_summary(3600, recording) == [
+        [5.0, 150, 1, 1, 1, 2, 60.0],
+    ]
+    assert manager.query_burden(recording) == pytest.approx(
+        [150, 1, 1, 1, 2, 100.0 * 2 / 150, 60.0])
+
+
+def test_upload_without_r_peaks_stores_counts_only(manager):
+    ecg = np.zeros(3000)
+    recording = manager.upload(np.arange(len(ecg)) / 100.0, ecg,
+                               [(10, 4), (2990, 1)], sample_rate=100,
+                               name="counts")
+
+    assert manager.query_summary(60, recording) == [
+        [0.0, None, 1, 0, 0, 1, None],
+    ]
+    assert manager.query_burden(recording) == [None, 1, 0, 0, 1, None, None]
+
+
+class FakeManager(object):
+    """ stands in for DatabaseManager, handing out a connection whose
+    cursor is never used by the fake loader
+    """
+
+    class Connection(object):
+        def cursor(self):
+            return self
+
+        def close(self):
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield {"conn": self.Connection()}
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """ replaces query_samples with a loader that records every window it
+    decodes, and blocks while the release event is clear
+    """
+
+    loads = {"windows": [], "release": threading.Event(),
+             "started": threading.Event()}
+    loads["release"].set()
+
+    def query_samples(c, metadata, first, last):
+        loads["windows"].append((metadata.recording, first))
+        loads["started"].set()
+        assert loads["release"].wait(5)
+        return np.arange(first, last, dtype=dm.BLOB_DTYPE)
+
+    monkeypatch.setattr(dm, "query_samples", query_samples)
+    return loads
+
+
+METADATA = dm.Metadata(1, 1000, 10.0, 0.0, 10, None)
+
+
+def test_window_cache_hits_and_evicts(loads):
+    # windows of 20 s at 10 Hz are 200 samples, and two of them fit
+    cache = dm.WindowCache(FakeManager(), max_bytes=2 * 200 * 4,
+                           tile_seconds=20)
+    assert cache.read(METADATA, 150, 250).tolist() == list(range(150, 250))
+    assert cache.read(METADATA, 0, 400).tolist() == list(range(400))
+    assert loads["windows"] == [(1, 0), (1, 200)]
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 2
+
+    cache.read(METADATA, 400, 600)
+    assert cache.stats()["evictions"] == 1
+    cache.read(METADATA, 200, 400)
+    assert len(loads["windows"]) == 3
+    cache.read(METADATA, 0, 200)
+    assert loads["windows"][-1] == (1, 0)
+    assert cache.stats()["windows"] == 2
+
+
+def test_window_cache_loads_each_window_once(loads):
+    cache = dm.WindowCache(FakeManager(), tile_seconds=20)
+    loads["release"].clear()
+    cache.prefetch(METADATA, 0, 400)
+    assert loads["started"].wait(5)
+
+    # the prefetch thread is decoding window 0 while a session asks for it
+    reader = threading.Thread(target=cache.read, args=(METADATA, 0, 400))
+    reader.start()
+    loads["release"].set()
+    reader.join(5)
+    assert not reader.is_alive()
+    for _ in range(500):
+        with cache._lock:
+            if not cache._pending:
+                break
+        time.sleep(0.01)
+
+    assert sorted(loads["windows"]) == [(1, 0), (1, 200)]
+    assert cache.read(METADATA, 0, 400).tolist() == list(range(400))
+    assert len(loads["windows"]) == 2
+    assert 1 <= cache.stats()["prefetched"] <= 2
+
+
+def test_envelope_levels_match_raw_buckets():
+    ecg = np.random.RandomState(2).randn(12345).astype(dm.BLOB_DTYPE)
+    for level, envelope in dm.build_envelope(ecg, [10, 100, 250, 1000]):
+        starts = np.arange(0, len(ecg), level)
+        assert np.array_equal(envelope[:, 0], np.minimum.reduceat(ecg, starts))
+        assert np.array_equal(envelope[:, 1], np.maximum.reduceat(ecg, starts))
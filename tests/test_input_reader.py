@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pytest
+import benchmark
+import holter_monitor_errors as hme
+import input_reader as ir
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "data", "")
+
+
+def baseline_txt(path):
+    """ the line-by-line parser read_txt replaced """
+
+    with open(path) as f:
+        return np.array([int(i) for i in f.read().splitlines()])
+
+
+@pytest.mark.parametrize("filename", ["ecg.txt", "DATALOG.TXT"])
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_read_txt_matches_baseline(filename, use_mmap):
+    time, ecg = ir.read_txt(filename, DATA, use_mmap=use_mmap)
+    expected = baseline_txt(ir.file_path(DATA, filename))
+    assert ecg.dtype == np.int32
+    assert np.array_equal(ecg, expected)
+    assert len(time) == len(expected)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_iter_txt_chunks_match_baseline(tmpdir, use_mmap):
+    values = np.random.RandomState(0).randint(-2048, 4096, 5000)
+    path = tmpdir.join("log.txt")
+    path.write_binary(b"\r\n".join(b"%d" % v for v in values) + b"\r\n")
+    folder = os.path.join(str(tmpdir), "")
+    chunks = [ecg for (time, ecg) in ir.iter_txt("log.txt", folder,
+                                                 chunk_bytes=997,
+                                                 use_mmap=use_mmap)]
+    assert len(chunks) > 1
+    assert np.array_equal(np.concatenate(chunks), values)
+
+
+@pytest.mark.parametrize("chunk, expected", [
+    (b"1\n\n-2\n", [1, -2]),
+    (b"\r\n+3\r\n\r\n4", [3, 4]),
+    (b" 5 \n\t\n6\n", [5, 6]),
+    (b"", []),
+])
+def test_parse_txt_chunk_skips_blank_rows(chunk, expected):
+    assert ir.parse_txt_chunk(chunk, "log.txt").tolist() == expected
+
+
+@pytest.mark.parametrize("chunk", [
+    b"2 3\n", b"1\t2\n", b"1\n \n2 3\n", b"1.5\n", b"x\n", b"3x\n",
+    b"2147483648\n",
+])
+def test_parse_txt_chunk_rejects_malformed_rows(chunk):
+    with pytest.raises(hme.DataFormatError):
+        ir.parse_txt_chunk(chunk, "log.txt")
+
+
+@pytest.mark.parametrize("fs", [1000, 488, 250])
+def test_convert_round_trips_lvm(tmpdir, fs):
+    folder = os.path.join(str(tmpdir), "")
+    ecg, pvcs = benchmark.synthetic_ecg(30, fs)
+    filename = benchmark.write_recording(ecg, "lvm", folder, fs)
+    ir.convert(filename, "converted.hmr", folder)
+    time, converted = ir.read_native("converted.hmr", folder)
+    lvm_time, lvm_ecg = ir.read_lvm(filename, folder)
+    assert ir.read_native_header(folder + "converted.hmr")["sample_rate"] \
+        == fs
+    assert np.allclose(converted, lvm_ecg, atol=1e-6)
+    assert np.allclose(time[:], lvm_time, atol=1e-6)
+
+
+@pytest.mark.parametrize("block_size", [None, 4096])
+def test_convert_round_trips_txt(tmpdir, block_size):
+    folder = os.path.join(str(tmpdir), "")
+    tmpdir.join("log.txt").write_binary(
+        open(ir.file_path(DATA, "DATALOG.TXT"), "rb").read())
+    ir.convert("log.txt", "log.hmr", folder, block_size=block_size)
+    time, converted = ir.read_native("log.hmr", folder)
+    assert np.array_equal(converted, baseline_txt(folder + "log.txt"))
+    assert time.sample_rate == 1000
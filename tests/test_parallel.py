@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+import input_reader as ir
+import pvc_detect_two as pvc_detect
+import pvc_parallel
+import pvc_stream
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "data", "")
+
+
+@pytest.mark.parametrize("filename, segment", [
+    ("ecg.txt", 15),
+    ("ecg.txt", 600),
+    ("DATALOG.TXT", 600),
+    ("DATALOG.TXT", 15),
+    ("DATALOG.TXT", 5),
+    ("pvcs.lvm", 60),
+])
+def test_parallel_matches_batch(filename, segment):
+    time, ecg = ir.read_data(filename, DATA)
+    batch_beats = []
+    parallel_beats = []
+    batch = pvc_detect.process_data(1000, 10, ecg, beats=batch_beats)
+    parallel = pvc_parallel.process_parallel(1000, 10, ecg, workers=2,
+                                             segment=segment, overlap=5,
+                                             beats=parallel_beats)
+    assert parallel_beats == batch_beats
+    assert parallel == batch
+
+
+def test_segment_bounds():
+    assert pvc_parallel.segment_bounds(20, 5, 60) == [(0, 20)]
+    assert pvc_parallel.segment_bounds(178, 60, 60) == [(0, 60), (60, 178)]
+    assert pvc_parallel.segment_bounds(180, 60, 60) == [(0, 60), (60, 120),
+                                                         (120, 180)]
+    assert pvc_parallel.segment_bounds(250, 100, 60) == [(0, 100),
+                                                         (100, 250)]
+
+
+def segment_result(r_peaks):
+    r_peaks = np.array(r_peaks)
+    running_mode = pvc_stream.RunningMode()
+    running_mode.update(np.zeros(10))
+    return r_peaks, -r_peaks.astype(float), running_mode
+
+
+@pytest.mark.parametrize("before, after, expected", [
+    # found by both segments on the same side of the seam
+    ([800, 995], [995, 1300], [800, 995, 1300]),
+    ([800, 1003], [1003, 1300], [800, 1003, 1300]),
+    # found a few samples apart on either side of it
+    ([800, 997], [1002, 1300], [800, 997, 1300]),
+    ([800, 1003], [998, 1300], [800, 1003, 1300]),
+    ([800, 960, 1003], [998, 1300], [800, 960, 1003, 1300]),
+    # found only outside the bounds of the segment that found it
+    ([800, 1050], [1300], [800, 1300]),
+    ([800], [950, 1300], [800, 1300]),
+    # close beats found by one segment are both kept
+    ([800, 900, 960], [960, 1300], [800, 900, 960, 1300]),
+])
+def test_stitch_merges_beats_at_seam(before, after, expected):
+    r_peaks, peak_values, mode = pvc_parallel.stitch(
+        [segment_result(before), segment_result(after)],
+        [(0, 1000), (1000, 2000)], 1000)
+    assert r_peaks.tolist() == expected
+    assert peak_values.tolist() == [-peak for peak in expected]
@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+import holter_monitor_constants as hmc
+import pvc_detect_two as pvc_detect
+
+
+def test_rolling_baseline_matches_sorted_window():
+    rng = np.random.RandomState(0)
+    baseline = pvc_detect.RollingBaseline()
+    window = []
+    for step in range(5000):
+        if window and rng.rand() < 0.45:
+            distance = window.pop(rng.randint(len(window)))
+            baseline.remove(distance)
+        else:
+            # few distinct values, so that duplicates straddle both halves
+            distance = int(rng.randint(600, 620))
+            window.append(distance)
+            baseline.add(distance)
+        assert len(baseline) == len(window)
+        if window:
+            assert baseline.median() == np.median(window)
+
+
+@pytest.mark.parametrize("beats", [1, 8, 51, 400])
+def test_rolling_averages_are_centered_medians(beats):
+    distances = np.random.RandomState(1).randint(400, 1500, 3000)
+    half = beats // 2
+    expected = [np.median(distances[max(i - half, 0):i + half + 1])
+                for i in range(len(distances))]
+    assert np.array_equal(
+        pvc_detect.get_rolling_averages(distances, beats), expected)
+
+
+# the loop implementations the vectorized criteria replaced, kept as the
+# reference they must agree with
+def loop_get_distances(r_peaks, fs):
+    distances = [None] * (len(r_peaks) - 1)
+    r_peak_times = []
+    for i in range(1, len(r_peaks)):
+        distances[i - 1] = r_peaks[i] - r_peaks[i - 1]
+        r_peak_times.append(r_peaks[i] / fs)
+    return distances, r_peak_times
+
+
+def loop_get_indexes(r_peak_times, window):
+    indexes = []
+    multiplier = 1
+    for i in range(0, len(r_peak_times)):
+        if r_peak_times[i] >= multiplier * window:
+            indexes.append(i)
+            multiplier += 1
+    return indexes
+
+
+def loop_remove_outliers(distances):
+    sorted = np.sort(distances)
+    length = len(sorted)
+    first_quartile = sorted[int(length / 4)]
+    third_quartile = sorted[int(3 * length / 4)]
+    iqr = third_quartile - first_quartile
+    dist = []
+    for i in range(0, len(distances)):
+        if distances[i] >= (first_quartile - 1.5 * iqr) and \
+                distances[i] <= (third_quartile + 1.5 * iqr):
+            dist.append(distances[i])
+    return dist
+
+
+def loop_get_averages(distances, indexes):
+    averages = [np.mean(loop_remove_outliers(distances[0:indexes[0]]))]
+    for i in range(1, len(indexes)):
+        averages.append(np.mean(loop_remove_outliers(
+            distances[indexes[i - 1]:indexes[i]])))
+    averages.append(np.mean(distances[indexes[len(indexes) - 1]:]))
+    return averages
+
+
+def loop_process_pvc(signal, distances, averages, indexes, r_peaks,
+                     prematurity, compensatory, dist, mode):
+    count = 0
+    pvc_count = 0
+    pvc_indexes_25 = []
+    pvc_indexes_50 = []
+    pvc_indexes_75 = []
+    pvc_indexes_100 = []
+
+    for i in range(0, len(distances) - 2):
+        if i > 0 and count < len(indexes) and i > indexes[count]:
+            count += 1
+        percent_error_one = (distances[i] - averages[count]) / averages[count]
+        if percent_error_one <= -prematurity:
+            pvc_indexes_25.append(r_peaks[i + 1])
+            percent_error_two = (distances[i + 1] - averages[count]) / averages[count]
+            if percent_error_two >= compensatory:
+                pvc_indexes_25.pop((len(pvc_indexes_25) - 1))
+                pvc_indexes_50.append(r_peaks[i + 1])
+                test_dist = (distances[i + 1] + distances[i]) / 2
+                test_dist_percent_error = (test_dist - averages[count]) / averages[count]
+                if abs(test_dist_percent_error) <= dist:
+                    pvc_indexes_50.pop((len(pvc_indexes_50) - 1))
+                    pvc_indexes_75.append(r_peaks[i + 1])
+                    if signal[r_peaks[i + 1]] < mode:
+                        pvc_indexes_75.pop((len(pvc_indexes_75) - 1))
+                        pvc_indexes_100.append(r_peaks[i + 1])
+                        pvc_count += 1
+    return pvc_indexes_25, pvc_indexes_50, pvc_indexes_75, pvc_indexes_100, pvc_count
+
+
+def random_beats(rng, count, fs):
+    """ R-peaks of a rhythm with drifting rate, ectopic beats and pauses
+    """
+
+    rr = rng.normal(800, 40, count) * (1 + 0.2 * np.sin(np.arange(count) / 50))
+    premature = np.flatnonzero(rng.rand(count - 1) < 0.05)
+    rr[premature] *= rng.uniform(0.5, 0.8, len(premature))
+    rr[premature + 1] *= rng.uniform(1.1, 1.6, len(premature))
+    rr[rng.rand(count) < 0.005] *= 3
+    return np.cumsum(np.round(rr * fs / 1000).astype(np.int64))
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("window", [3, 10, 60])
+def test_vectorized_criteria_match_loops(seed, window):
+    fs = 1000
+    rng = np.random.RandomState(seed)
+    r_peaks = random_beats(rng, 2000, fs)
+    signal = rng.normal(0, 1, r_peaks[-1] + 1)
+    mode = 0.0
+
+    distances, r_peak_times = pvc_detect.get_distances(r_peaks, fs)
+    expected_distances, expected_times = loop_get_distances(r_peaks, fs)
+    assert np.array_equal(distances, expected_distances)
+    assert np.array_equal(r_peak_times, expected_times)
+
+    indexes = pvc_detect.get_indexes(r_peak_times, window)
+    assert np.array_equal(indexes, loop_get_indexes(expected_times, window))
+
+    averages = pvc_detect.get_averages(distances, indexes)
+    expected_averages = loop_get_averages(expected_distances, indexes)
+    assert np.allclose(averages, expected_averages, rtol=1e-12)
+
+    tiers = pvc_detect.process_pvc(signal, distances, expected_averages,
+                                   indexes, r_peaks, hmc.PREMATURITY,
+                                   hmc.COMPENSATORY,
+                                   hmc.DISTANCE, mode=mode)
+    expected_tiers = loop_process_pvc(signal, expected_distances,
+                                      expected_averages, indexes, r_peaks,
+                                      hmc.PREMATURITY,
+                                      hmc.COMPENSATORY,
+                                      hmc.DISTANCE, mode)
+    for tier, expected in zip(tiers, expected_tiers):
+        assert np.array_equal(tier, expected)
+    assert sum(len(tier) for tier in expected_tiers[1:4]) > 0
+
+    detection = pvc_detect.Detection(None, signal, r_peaks, distances,
+                                     r_peak_times, indexes, averages, mode,
+                                     tiers[:4])
+    expected_locations = sorted(
+        [(index, certainty) for certainty, tier in enumerate(expected_tiers[:4], 1)
+         for index in tier], key=lambda pair: pair[0])
+    assert pvc_detect.pvc_locations(detection) == expected_locations
+
+
+@pytest.mark.parametrize("length", [1, 2, 3, 4, 7, 50])
+def test_remove_outliers_matches_loop(length):
+    distances = np.random.RandomState(length).randint(300, 1500, length)
+    distances[0] = 5000
+    assert np.array_equal(pvc_detect.remove_outliers(distances),
+                          loop_remove_outliers(distances))
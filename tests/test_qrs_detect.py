@@ -0,0 +1,37 @@
+import os
+import numpy as np
+import pytest
+import benchmark
+import filter_functions as ff
+import holter_monitor_constants as hmc
+import input_reader as ir
+import qrs_detect
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+FS = 1000
+
+
+def detect(detector, ecg):
+    lpf = ff.butter_lowpass_filter(data=ecg, cutoff=hmc.CUTOFF, fs=FS)
+    return np.sort(qrs_detect.get_detector(detector)(lpf, FS)[0])
+
+
+@pytest.mark.parametrize("folder, filename", [
+    ("data", "ecg.txt"), ("data", "pvcs.lvm"), ("data", "pvcrun.lvm"),
+    ("data_2", "multipvc.lvm"), ("data_2", "nsr60.lvm"),
+    ("data_2", "pvc.lvm"),
+])
+def test_pan_tompkins_agrees_with_biosppy(folder, filename):
+    time, ecg = ir.read_data(filename, os.path.join(ROOT, folder, ""))
+    reference = detect("biosppy", ecg)
+    found = detect("pan_tompkins", ecg)
+    distances = benchmark.nearest_distances(found, reference)
+    assert np.mean(distances <= 0.05 * FS) >= 0.95
+
+
+@pytest.mark.parametrize("detector", ["biosppy", "pan_tompkins"])
+def test_detectors_place_pvcs_on_their_r_peaks(detector):
+    ecg, pvcs = benchmark.synthetic_ecg(300, FS)
+    distances = benchmark.nearest_distances(detect(detector, ecg), pvcs)
+    # as benchmark.py counts a PVC found
+    assert np.mean(distances <= 0.1 * FS) >= 0.9
@@ -0,0 +1,25 @@
+import os
+import sqlite3 as sql3
+import database_manager as dm
+
+
+def test_viewer_queries_seek_an_index(tmpdir):
+    conn = sql3.connect(os.path.join(str(tmpdir), "plans.db"))
+    try:
+        c = conn.cursor()
+        dm.create_schema(c)
+        assert dm.unindexed_queries(c) == {}
+    finally:
+        conn.close()
+
+
+def test_uploaded_recording_still_seeks_an_index(tmpdir):
+    path = os.path.join(str(tmpdir), "plans.db")
+    ecg = [0.0] * 30000
+    dm.upload([0.0] * len(ecg), ecg, [(100, 1)], path=path, name="flat",
+              r_peaks=[100, 900, 1700])
+    conn = sql3.connect(path)
+    try:
+        assert dm.unindexed_queries(conn.cursor()) == {}
+    finally:
+        conn.close()
@@ -0,0 +1,46 @@
+import os
+import pytest
+import input_reader as ir
+import pvc_detect_two as pvc_detect
+import pvc_stream
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+RECORDINGS = [("data", "ecg.txt"), ("data", "DATALOG.TXT"),
+              ("data", "pvcs.lvm"), ("data", "pvcrun.lvm"),
+              ("data_2", "multipvc.lvm"), ("data_2", "nsr60.lvm"),
+              ("data_2", "pvc.lvm")]
+batches = {}
+
+
+def batch(folder, filename, detector, baseline_beats):
+    key = (folder, filename, detector, baseline_beats)
+    if key not in batches:
+        time, ecg = ir.read_data(filename, os.path.join(ROOT, folder, ""))
+        beats = []
+        pvcs = pvc_detect.process_data(1000, 10, ecg, detector=detector,
+                                       baseline_beats=baseline_beats,
+                                       beats=beats)
+        batches[key] = pvcs, beats
+    return batches[key]
+
+
+@pytest.mark.parametrize("folder, filename", RECORDINGS)
+@pytest.mark.parametrize("detector", ["biosppy", "pan_tompkins"])
+@pytest.mark.parametrize("baseline_beats", [0, 8])
+@pytest.mark.parametrize("chunk_size", [7919, 50000, 262144])
+def test_stream_matches_batch(folder, filename, detector, baseline_beats,
+                              chunk_size):
+    pvcs, beats = batch(folder, filename, detector, baseline_beats)
+    chunks = ir.read_data(filename, os.path.join(ROOT, folder, ""),
+                          chunk_size=chunk_size)
+    stream_beats = []
+    stream_pvcs = list(pvc_stream.process_stream(
+        1000, 10, chunks, baseline_beats=baseline_beats, detector=detector,
+        beats=stream_beats))
+    assert stream_beats == beats
+    assert [index for (index, certainty) in stream_pvcs] == \
+        [index for (index, certainty) in pvcs]
+    # the fourth criterion compares with the mode of the signal so far, so
+    # only it may differ from the mode of the whole recording
+    assert [min(certainty, 3) for (index, certainty) in stream_pvcs] == \
+        [min(certainty, 3) for (index, certainty) in pvcs]
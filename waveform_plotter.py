@@ -3,6 +3,8 @@ import matplotlib.pyplot as plt
 import mpld3
 import numpy as np
 import bisect as bis
+import functools as ft
+from concurrent import futures
 import bokeh.plotting as bp
 import bokeh.models as bm
 import bokeh.models.widgets as bmw
@@ -11,27 +13,44 @@ import bokeh.io as bio
 from bokeh.palettes import Reds8 as r8
 from mpld3 import plugins, utils
 import database_manager as dm
+import filter_functions as ff
 import holter_monitor_constants as hmc
 import holter_monitor_errors as hme
 import logging
 log = logging.getLogger("hm_logger")
 
+# shared by every viewer session, so a slow range query never runs on the
+# server's event loop
+query_executor = futures.ThreadPoolExecutor(
+    max_workers=hmc.VIEWER_WORKERS)
+
 
 def render_full_plot(min=0,
                      max=2,
-                     query_window=80):
-
-    data_length = dm.query_length()
-    pvcs = np.array(dm.query_pvcs())
+                     query_window=80,
+                     db=None,
+                     recording=None):
+
+    db = dm.get_manager() if db is None else db
+    doc = bio.curdoc()
+    # read once, so picking a pyramid level never queries from the event
+    # loop; the session stays on this recording if another one is uploaded
+    metadata = db.metadata(recording)
+    recording = metadata.recording
+    data_length = metadata.length
+    pvcs = np.array(db.query_pvcs(recording))
 
     title = "Holter Monitor Data Visualizer"
     loading_mode = "loading..."
-    bio.curdoc().title = loading_mode
+    doc.title = loading_mode
+
+    tools = "crosshair,save,xbox_zoom,xwheel_zoom,xpan"
 
-    tools = "crosshair,save,xbox_zoom,xpan"
+    plot_width = hmc.PLOT_WIDTH
 
     fig = bp.figure(title=title,
                     tools=tools,
+                    plot_width=plot_width,
                     x_axis_label="time (s)",
                     y_axis_label="ECG Signal (V)",
                     y_range=(min, max))
@@ -45,21 +64,33 @@ def render_full_plot(min=0,
 
     fig.line('time', 'ecg', source=line_source)
 
+    def view_width():
+        # the data area is narrower than the figure, and the browser only
+        # reports its width once the figure has been laid out
+        try:
+            return fig.inner_width or plot_width
+        except (AttributeError, ValueError):
+            # not reported yet, or a Bokeh without the property
+            return plot_width
+
+    def view_points():
+        return hmc.POINTS_PER_PIXEL * view_width()
+
     try:
         pvc_indices = pvcs[:, 0]
         pvc_certainties = pvcs[:, 1]
+        pvc_times = pvcs[:, 2]
+        pvc_ecg = pvcs[:, 3]
     except IndexError:
         pvc_indices = []
         pvc_certainties = []
-
-    pvc_data = np.array(
-        [list(t) for t in [dm.query_point(i) for i in pvc_indices]]
-    )
+        pvc_times = []
+        pvc_ecg = []
 
     point_source = bm.ColumnDataSource(
         data=dict(
-            time=pvc_data[:, 0],
-            ecg=pvc_data[:, 1],
+            time=pvc_times,
+            ecg=pvc_ecg,
             certainty=pvc_certainties,
         )
     )
@@ -103,23 +134,137 @@ def render_full_plot(min=0,
     time_select = bmw.TextInput(title="Go to time: ")
 
     data_endpoints = [0, data_length]
-
-    def requery_data(index):
-        bio.curdoc().title = loading_mode
+    data_level = [0]  # pyramid level of line_source, 0 for raw samples
+    data_center = [None]  # center of the last raw window, to tell pan direction
+    data_bucket = [0]  # samples per pixel column of line_source
+    latest_request = [0]
+    applied_request = [0]
+
+    def submit_query(query, apply):
+        """ runs query on the shared executor and hands its result to apply
+        on the session's next tick; the result is dropped if another query
+        was submitted in the meantime
+
+        :param query: function taking no arguments that queries the database
+        :param apply: function called with the result of query
+        """
+
+        latest_request[0] += 1
+        request = latest_request[0]
+        doc.title = loading_mode
         fig.title.text = loading_mode
-        left_time, right_time = find_time_endpoints_from_index(index)
-        center = (left_time + right_time) / 2
-        data_endpoints[0] = center - query_window / 2
-        data_endpoints[1] = center + query_window / 2
-        time, ecg = dm.query_data(data_endpoints[0], data_endpoints[1])
+
+        def finish(future):
+            if request != latest_request[0]:
+                return
+            applied_request[0] = request
+            try:
+                apply(future.result())
+            except Exception as e:
+                # line_source no longer matches the recorded state
+                data_bucket[0] = 0
+                log.error("Viewer query failed: {0}".format(e))
+            doc.title = title
+            fig.title.text = title
+
+        future = query_executor.submit(query)
+        future.add_done_callback(
+            lambda done: doc.add_next_tick_callback(ft.partial(finish, done)))
+
+    def show_data(data):
         line_source.data = dict(
-            time=time,
-            ecg=ecg
+            time=data[0],
+            ecg=data[1]
         )
-        bio.curdoc().title = title
-        fig.title.text = title
+
+    def extend_data(data, rollover):
+        line_source.stream(dict(
+            time=data[0],
+            ecg=data[1]
+        ), rollover=rollover)
+
+    def requery_data(index):
+        left_time, right_time = find_time_endpoints_from_index(index)
+        load_samples(left_time, right_time)
         return left_time, right_time
 
+    def load_samples(left_time, right_time):
+        # buffer one view width on either side, in whole pixel columns so
+        # that a pan to the right only needs the samples past the buffer
+        width = right_time - left_time
+        center = (left_time + right_time) / 2
+        # max is shadowed by the y-range argument; rounding first keeps float
+        # noise in the view width from flipping the bucket as the view pans
+        bucket = int(np.ceil(round(width * hmc.SAMPLE_RATE / view_width(),
+                                   6))) or 1
+        step = float(bucket) / hmc.SAMPLE_RATE
+        start = np.floor((left_time - width) / step) * step
+        end = np.ceil((right_time + width) / step) * step
+        extend = applied_request[0] == latest_request[0] \
+            and data_level[0] == 0 and data_bucket[0] == bucket \
+            and 0 <= data_endpoints[0] <= start < data_endpoints[1] < end \
+            and data_endpoints[1] * hmc.SAMPLE_RATE <= data_length
+        query_start = data_endpoints[1] if extend else start
+        data_endpoints[0] = start
+        data_endpoints[1] = end
+        data_level[0] = 0
+        data_bucket[0] = bucket
+        direction = 0 if data_center[0] is None else center - data_center[0]
+        data_center[0] = center
+
+        def query():
+            time, ecg = db.query_data(query_start, end, recording)
+            prefetch_neighbours(center, direction, end - start)
+            log.debug("Window cache: {0}".format(db.cache_stats()))
+            return minmax_downsample(time, ecg, bucket)
+
+        if extend:
+            columns = int(round((end - start) / step))
+            rollover = columns * (2 if bucket > 1 else 1)
+            submit_query(query, lambda data: extend_data(data, rollover))
+        else:
+            submit_query(query, show_data)
+
+    def prefetch_neighbours(center, direction, width):
+        """ loads the windows the user is likely to look at next: the one
+        ahead in the pan direction, or both sides when it is not known, and
+        those of the PVCs before and after the current one
+        """
+
+        centers = []
+        if direction >= 0:
+            centers.append(center + width)
+        if direction <= 0:
+            centers.append(center - width)
+        following = bis.bisect_right(pvc_times, center)
+        preceding = bis.bisect_left(pvc_times, center) - 1
+        if following < len(pvc_times):
+            centers.append(pvc_times[following])
+        if preceding >= 0:
+            centers.append(pvc_times[preceding])
+        for neighbour in centers:
+            db.prefetch(neighbour - width / 2, neighbour + width / 2,
+                        recording)
+
+    def requery_envelope(left_time, right_time):
+        # buffer one view width on either side so small pans stay local
+        width = right_time - left_time
+        start = left_time - width
+        end = right_time + width
+        data_endpoints[0] = start
+        data_endpoints[1] = end
+        points = 3 * view_points()
+        data_level[0] = dm.select_level(metadata, end - start, points)
+        submit_query(lambda: db.query_envelope(start, end, points, recording),
+                     show_data)
+
+    def envelope_outdated(left_time, right_time):
+        width = right_time - left_time
+        level = dm.select_level(metadata, 3 * width, 3 * view_points())
+        return level != data_level[0] \
+            or left_time < data_endpoints[0] \
+            or right_time > data_endpoints[1]
+
     def find_time_endpoints_from_index(index):
         w_range = hmc.SAMPLE_RATE * window_slider.value
         left, right = find_range(index, w_range, data_length)
@@ -130,6 +275,7 @@ def render_full_plot(min=0,
     def safe_query(index):
         left_time, right_time = requery_data(index) \
             if not (fig.x_range.start and fig.x_range.end) \
+               or data_level[0] != 0 \
                or index < data_endpoints[0] * hmc.SAMPLE_RATE \
                or index > data_endpoints[1] * hmc.SAMPLE_RATE \
             else find_time_endpoints_from_index(index)
@@ -149,16 +295,36 @@ def render_full_plot(min=0,
 
     def refresh_data():
         if fig.x_range.start and fig.x_range.end:
-            if fig.x_range.start < data_endpoints[0]:
-                requery_data(fig.x_range.start * hmc.SAMPLE_RATE)
-            elif fig.x_range.end > data_endpoints[1]:
-                requery_data(fig.x_range.end * hmc.SAMPLE_RATE)
+            if fig.x_range.end - fig.x_range.start > query_window:
+                # zoomed out past the raw buffer: show the min/max pyramid
+                if envelope_outdated(fig.x_range.start, fig.x_range.end):
+                    requery_envelope(fig.x_range.start, fig.x_range.end)
+            elif data_level[0] != 0 \
+                    or fig.x_range.start < data_endpoints[0] \
+                    or fig.x_range.end > data_endpoints[1] \
+                    or (fig.x_range.end - fig.x_range.start) * \
+                    hmc.SAMPLE_RATE / view_width() < data_bucket[0] / 2:
+                # new range, or zoomed in past the resolution of the samples
+                load_samples(fig.x_range.start, fig.x_range.end)
             time_select.remove_on_change("value", time_callback)
             time_select.value = display_time((fig.x_range.start + fig.x_range.end) / 2)
             time_select.on_change("value", time_callback)
 
-    fig.x_range.on_change('start', lambda attr, old, new: refresh_data())
-    fig.x_range.on_change('end', lambda attr, old, new: refresh_data())
+    refresh_pending = [False]
+
+    def schedule_refresh():
+        # start and end change one after the other, so the range is only
+        # checked once both have been updated
+        if not refresh_pending[0]:
+            refresh_pending[0] = True
+            doc.add_next_tick_callback(run_refresh)
+
+    def run_refresh():
+        refresh_pending[0] = False
+        refresh_data()
+
+    fig.x_range.on_change('start', lambda attr, old, new: schedule_refresh())
+    fig.x_range.on_change('end', lambda attr, old, new: schedule_refresh())
 
     def update_range(left_time, right_time):
         fig.x_range.start = left_time
@@ -166,7 +332,7 @@ def render_full_plot(min=0,
 
     if len(pvc_strings) > 0:
         pvc_select = bmw.Select(
-            title="Detected " + str(len(pvcs)) + " PVCs:",
+            title=pvc_title(len(pvcs), db.query_burden(recording)),
             value=pvc_strings[0],
             options=pvc_strings
         )
@@ -226,7 +392,7 @@ def render_full_plot(min=0,
         pvc_info_string
     )
 
-    bio.curdoc().add_root(
+    doc.add_root(
         bl.row(
             fig,
             controls
@@ -236,10 +402,24 @@ def render_full_plot(min=0,
     log.debug("Successfully rendered full plot")
 
 
+def pvc_title(count, burden):
+    """ titles the PVC selector with the PVC count and, when the beats of
+    the recording are known, its PVC burden
+
+    :param count: number of detected PVCs of any certainty
+    :param burden: stored PVC totals, as returned by query_burden, or None
+    :return: title string
+    """
+
+    if burden is None or burden[5] is None:
+        return "Detected " + str(count) + " PVCs:"
+    return "Detected {0} PVCs ({1:.1f}% burden):".format(count, burden[5])
+
+
 def format_pvcs(pvcs):
     """ formats pvcs into a list of readable strings
 
-    :param pvcs: list of pvc indices and certainties from peak detection
+    :param pvcs: list of pvc indices, certainties, times and amplitudes
     :return: list of pvc strings
     """
     return [
@@ -247,9 +427,7 @@ def format_pvcs(pvcs):
         + " condition"
         + ("s" if round(pvc[1]) > 1 else "")
         + " met @ "
-        + display_time(
-            dm.query_point(pvc[0])[0]
-        )
+        + display_time(pvc[2])
         for pvc in pvcs
     ]
 
@@ -440,6 +618,25 @@ def find_range(index, window, max):
     )
 
 
+def minmax_downsample(time, ecg, bucket):
+    """ reduces a trace to the smallest and largest sample of each bucket,
+    in the order they occur, so that R-peaks and the troughs of PVCs are
+    drawn at their true times and amplitudes
+
+    :param time: time data array
+    :param ecg: ecg data array
+    :param bucket: number of samples reduced to each pair of points
+    :return: downsampled time and ecg data arrays
+    """
+
+    if bucket <= 1:
+        return time, ecg
+    lows, highs = ff.minmax_buckets(ecg, bucket)
+    points = np.column_stack((np.minimum(lows, highs),
+                              np.maximum(lows, highs))).ravel()
+    return np.asarray(time)[points], np.asarray(ecg)[points]
+
+
 def render_pvc_plot(time, ecg, pvcs, window=3, html_filename="pvcs.html"):
     """ renders an interactive plot in a browser for viewing PVCs over 24 hrs
 